@@ -1,56 +1,246 @@
-from app import models
+from app import models, config
+from app.api import redis_rq
+from app.api.utils import renderers, samplers
+from app.api.jobs import render_pipelines, art_writers, trait_statistics, progress
 
-import pathlib
-from PIL import Image
+import math
+import time
 import random
-import hashlib
-import io
 import datetime
-import itertools
 import collections
 
+from pymongo import UpdateOne
+
+
+class DnaIndex:
+    def __init__(self, collection):
+        self.collection = collection
+        self.hashes = set()
+
+    def load(self, backfill=True):
+        self.hashes = set()
+
+        missing_hashes = []
+        art_images = (
+            models.ArtImage.objects(collection=self.collection)
+            .only("components", "dna_hash")
+            .as_pymongo()
+        )
+        for data in art_images:
+            dna_hash = data.get("dna_hash")
+            if not dna_hash:
+                dna_hash = models.ArtImage.get_dna_hash(
+                    getattr(c, "id", c) for c in data.get("components", [])
+                )
+                missing_hashes.append(
+                    UpdateOne({"_id": data["_id"]}, {"$set": {"dna_hash": dna_hash}})
+                )
+
+            self.hashes.add(dna_hash)
+
+        if missing_hashes and backfill:
+            models.ArtImage._get_collection().bulk_write(missing_hashes, ordered=False)
+
+        print("dna index", len(self.hashes), "backfilled", len(missing_hashes))
+
+    def get_hash(self, components):
+        return models.ArtImage.get_dna_hash(c.id for c in components)
+
+    def contains(self, components):
+        return self.get_hash(components) in self.hashes
+
+    def add(self, components):
+        dna_hash = self.get_hash(components)
+        self.hashes.add(dna_hash)
+        return dna_hash
+
 
 class SimpleImageGenerator:
     def __init__(self, collection_operation):
         self.collection_operation = collection_operation
         self.MAX_TRY = 1000
 
+        self.seed = collection_operation.parameters.get("seed")
+        if self.seed is None:
+            self.seed = random.randrange(2**32)
+        self.random = random.Random(self.seed)
+        self.sampler = None
+        self.resumed = False
+        self.dry_run = False
+        self.dry_images = []
+        self.tries = 0
+        self.rejected = 0
+        self.progress = None
+        self.selected = time.perf_counter()
+        self.checkpoint_interval = collection_operation.parameters.get(
+            "checkpoint_interval", 1000
+        )
+
+        self.cache_size = collection_operation.parameters.get(
+            "layer_cache_size", config.settings.LAYER_CACHE_SIZE
+        )
+        self.prefix_cache_size = collection_operation.parameters.get(
+            "prefix_cache_size", config.settings.PREFIX_CACHE_SIZE
+        )
+        self.compositor = collection_operation.parameters.get("compositor", "pillow")
+        self.render_mode = collection_operation.parameters.get("render_mode", "eager")
+        self.encoder = collection_operation.collection.encoder or {}
+        self.renderer = renderers.get_renderer(
+            self.compositor,
+            self.load_component_image,
+            self.cache_size,
+            self.prefix_cache_size,
+            self.encoder,
+        )
+        self.dna_index = DnaIndex(collection_operation.collection)
+        self.writer = art_writers.BulkArtImageWriter(
+            collection_operation.parameters.get("batch_size", 100)
+        )
+        self.pipeline = render_pipelines.SerialRenderPipeline(
+            self.renderer, self.save_image
+        )
+
+    def load_component_image(self, component_id, cropped=False):
+        return models.ComponentImage.load_layer(component_id, cropped)
+
+    def get_base_keys(self, component_layers, amount):
+        base_keys = []
+        for components in component_layers:
+            # optional layers always carry the blank option, so a single
+            # option means a required layer
+            if len(components) != 1:
+                break
+
+            c = components[0]
+            if not c["component"] or c["quota"] - c["count"] < amount:
+                break
+
+            base_keys.append(c["component"].id)
+
+        return base_keys
+
+    def get_layer_images(self, component_layers):
+        # a stack starts at its first chosen layer, so only layers up to the
+        # first required one are ever drawn uncropped
+        layer_images = {}
+        uncropped = True
+        for components in component_layers:
+            for c in components:
+                if not c["component"]:
+                    continue
+
+                component_id = c["component"].id
+                layer = self.load_component_image(component_id, True)
+                if uncropped:
+                    full = self.load_component_image(component_id)
+                    layer_images[(component_id, False)] = full
+                    # opaque layers crop to themselves, send their bytes once
+                    if layer == full:
+                        layer = full
+
+                layer_images[(component_id, True)] = layer
+
+            if all(c["component"] for c in components):
+                uncropped = False
+
+        return layer_images
+
+    def create_pipeline(self, component_layers, base_keys=None):
+        self.renderer.set_base(base_keys or [])
+
+        workers = self.collection_operation.parameters.get("workers", 1)
+        if workers <= 1 or self.render_mode == "on-demand":
+            return render_pipelines.SerialRenderPipeline(self.renderer, self.save_image)
+
+        layer_images = self.get_layer_images(component_layers)
+        size = sum(len(data) for data, offset in layer_images.values() if data)
+
+        print(
+            "render pipeline with",
+            workers,
+            "workers",
+            len(layer_images),
+            "layers",
+            size,
+            "bytes",
+        )
+        return render_pipelines.ProcessRenderPipeline(
+            self.save_image,
+            layer_images,
+            self.cache_size,
+            workers,
+            self.compositor,
+            self.prefix_cache_size,
+            base_keys,
+            self.encoder,
+        )
+
     def create_image(self, image_id, components):
-        components[0].image.seek(0)
-        data = components[0].image.read()
-        img = Image.open(io.BytesIO(data))
-        image_class = components[0].component_class
-        for component in components[1:]:
-            component.image.seek(0)
-            data = component.image.read()
-            new_layer_img = Image.open(io.BytesIO(data))
-            img.paste(new_layer_img, (0, 0), new_layer_img)
+        if self.progress:
+            self.progress.add("dna", time.perf_counter() - self.selected)
+
+        self.dna_index.add(components)
+        if self.dry_run:
+            self.dry_images.append((image_id, components))
+            return
+
+        if self.render_mode == "on-demand":
+            self.save_image(image_id, components, None)
+        else:
+            self.pipeline.submit(image_id, components)
 
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format="PNG")
+        self.selected = time.perf_counter()
+
+    def save_image(self, image_id, components, data):
+        image_class = components[0].component_class
 
         name = f"{image_id}"
+        encoder = self.renderer.encoder
+        filename = f"{name}.{encoder.extension}"
 
         art_image = models.ArtImage(
-            name=f"#{name}",
-            description=f"#{name}",
+            name=filename,
+            description=f"#{filename}",
             collection=self.collection_operation.collection,
             owner=self.collection_operation.owner,
             command=self.collection_operation,
             components=components,
             image_class=image_class,
+            dna_hash=self.dna_index.get_hash(components),
+            token_id=image_id,
+        )
+        if data is None:
+            art_image.render_spec = dict(
+                encoder=self.encoder,
+                filename=filename,
+                content_type=encoder.content_type,
+            )
+
+        self.writer.add(art_image, data, filename, encoder.content_type)
+        if self.progress:
+            self.progress.advance()
+
+    def get_stage_times(self):
+        stats = self.pipeline.stats()
+        return dict(
+            fetch=stats.get("fetch_ms", 0) / 1000,
+            decode=stats.get("decode_ms", 0) / 1000,
+            composite=stats.get("composite_ms", 0) / 1000,
+            encode=stats.get("encode_ms", 0) / 1000,
+            write=self.writer.time,
         )
-        art_image.image.put(img_bytes, filename=f"{name}.png", content_type="image/png")
-        art_image.save()
 
-    def get_posible_image(self, layers):
+    def get_total(self, counter, until):
+        return until - counter
+
+    def get_posible_image(self, component_layers):
         posible_image = 1
-        if len(layers) == 0:
+        if len(component_layers) == 0:
             return posible_image
 
-        for l, components in layers.items():
+        for components in component_layers:
             counter = 0
-            for k, component in components.items():
+            for component in components:
                 if component["quota"] > 0:
                     counter += 1
 
@@ -67,7 +257,7 @@ class SimpleImageGenerator:
         results = []
 
         for layer in layers:
-            component_image = random.choice(layer)
+            component_image = self.random.choice(layer)
             if not component_image:
                 continue
 
@@ -76,13 +266,14 @@ class SimpleImageGenerator:
         return results
 
     def is_valide_dna(self, components):
-        art_image = models.ArtImage.objects(
-            collection=self.collection_operation.collection, components=components
-        ).first()
-
-        if art_image:
+        self.tries += 1
+        if self.dna_index.contains(components):
+            self.rejected += 1
             return False
 
+        if self.dry_run:
+            return True
+
         for c in components:
             print("->", c.image_layer.name, ":", c.name, end=" ")
         print()
@@ -90,68 +281,62 @@ class SimpleImageGenerator:
         return True
 
     def count_trait(self):
-
-        statistic = {}
-
-        collection = self.collection_operation.collection
-
-        art_images = models.ArtImage.objects(collection=collection)
-        for ai in art_images:
-            for c in ai.components:
-                if c not in statistic:
-                    statistic[c] = 0
-                statistic[c] += 1
-
-        total = sum(statistic.values())
-
-        total_image = len(art_images)
-        for component, v in statistic.items():
-            component.generated_number = v
-            component.rarity = 1 / (v / total)
-            component.rarity_percent = v / total_image * 100
-            component.save()
-
-        collection.generated_trait = total
-        collection.save()
-
-        art_images = models.ArtImage.objects(collection=collection).order_by("name")
-        counter = 1
-        for ai in art_images:
-            rarity = 0
-            rarity_percent = 0
-            for component in ai.components:
-                rarity += component.rarity
-                rarity_percent += component.rarity_percent
-
-            ai.rarity_percent = rarity_percent / len(ai.components)
-            ai.rarity = rarity
-            ai.name = f"{ai.filename}"
-            ai.description = f"#{ai.filename}"
-            counter += 1
-            print(ai.name, ai.image.filename)
-            ai.save()
+        trait_statistics.count_trait(self.collection_operation.collection)
 
     def shake_token_id(self):
-        art_images = list(
-            models.ArtImage.objects(collection=self.collection_operation.collection)
+        art_image_ids = list(
+            models.ArtImage.objects(
+                collection=self.collection_operation.collection
+            ).scalar("id")
         )
-        art_images = random.sample(art_images, len(art_images))
-        for index, ai in enumerate(art_images):
-            ai.name = f"#{index+1}"
-            ai.description = f"#{index+1}"
-            buffer_image = io.BytesIO(ai.image.read())
-            ai.image.replace(
-                buffer_image,
-                filename=f"{index+1}.png",
-                content_type=ai.image.content_type,
+        self.random.shuffle(art_image_ids)
+
+        updates = [
+            UpdateOne(
+                {"_id": art_image_id},
+                {
+                    "$set": {
+                        "token_id": index + 1,
+                        "name": f"#{index+1}",
+                        "description": f"#{index+1}",
+                    }
+                },
+            )
+            for index, art_image_id in enumerate(art_image_ids)
+        ]
+        if updates:
+            models.ArtImage._get_collection().bulk_write(updates, ordered=False)
+
+        print("shaked", len(updates), "token ids")
+
+    def get_layer_components(self, image_layers, component_class=None):
+        query = dict(image_layer__in=image_layers)
+        if component_class:
+            query["component_class"] = component_class
+
+        layer_components = {il.id: [] for il in image_layers}
+        for image_component in models.ComponentImage.objects(**query):
+            # read the stored reference so grouping does not fetch every layer
+            layer_id = trait_statistics.get_reference_id(
+                image_component._data.get("image_layer")
             )
-            ai.save()
-            print(ai.name, ai.image.filename)
+            layer_components[layer_id].append(image_component)
+
+        for il in image_layers:
+            for image_component in layer_components[il.id]:
+                image_component.image_layer = il
+
+        return layer_components
 
     def get_component_quotas(self, component_class="A"):
-        image_layers = models.ImageLayer.objects(
-            collection=self.collection_operation.collection,
-        ).order_by("order")
+        started = time.perf_counter()
+
+        collection = self.collection_operation.collection
+        image_layers = list(
+            models.ImageLayer.objects(collection=collection).order_by("order")
+        )
+        layer_components = self.get_layer_components(image_layers, component_class)
+        usage = trait_statistics.count_component_usage(collection)
 
         amount = self.collection_operation.amount
 
@@ -159,14 +344,14 @@ class SimpleImageGenerator:
         for il in image_layers:
             image_components = dict()
             total = 0
-            for image_component in list(il.get_images(component_class=component_class)):
+            for image_component in layer_components[il.id]:
                 quota = int(round(amount * (image_component.rarity_weight / 100)))
                 if quota == 0:
                     continue
 
                 data = dict(
                     quota=0,
-                    count=image_component.count_art_image(),
+                    count=usage.get(image_component.id, 0),
                     component=image_component,
                 )
                 if quota + total < amount:
@@ -193,14 +378,122 @@ class SimpleImageGenerator:
                 data = dict(quota=quota, count=0, component=None)
                 image_components[None] = data
 
+        print(
+            "component quotas",
+            len(image_layers),
+            "layers",
+            sum(len(c) for c in layer_components.values()),
+            "components in",
+            f"{(time.perf_counter() - started) * 1000:.1f}ms",
+        )
         return layers
 
-    def generate(self, counter, until, layers):
-        component_layers = []
-        for l in layers.values():
-            component_layers.append(list(l.values()))
+    def dump_layers(self, component_layers):
+        return [
+            [
+                [
+                    str(c["component"].id) if c["component"] else None,
+                    c["quota"],
+                    c["count"],
+                ]
+                for c in components
+            ]
+            for components in component_layers
+        ]
+
+    def load_layers(self, data):
+        component_ids = [c[0] for components in data for c in components if c[0]]
+        component_images = {
+            str(c.id): c for c in models.ComponentImage.objects(id__in=component_ids)
+        }
+
+        return [
+            [
+                dict(
+                    quota=quota,
+                    count=count,
+                    component=component_images.get(component_id)
+                    if component_id
+                    else None,
+                )
+                for component_id, quota, count in components
+            ]
+            for components in data
+        ]
+
+    def get_random_state(self):
+        version, internal, gauss = self.random.getstate()
+        return [version, list(internal), gauss]
+
+    def set_random_state(self, state):
+        version, internal, gauss = state
+        self.random.setstate((version, tuple(internal), gauss))
+
+    def checkpoint(self, counter, until, position, component_layers):
+        if self.dry_run or position % self.checkpoint_interval:
+            return
+
+        started = time.perf_counter()
+
+        # everything before position must be stored before it is recorded
+        self.pipeline.flush()
+        self.writer.flush()
+
+        # the sampler swaps grow with every draw, keep them in gridfs so the
+        # checkpoint stays far below the document size limit
+        previous_file = self.collection_operation.checkpoint.get("sampler_file")
+        sampler_file = None
+        if self.sampler:
+            sampler_file = self.collection_operation.put_checkpoint_data(
+                self.sampler.getstate()
+            )
+
+        self.collection_operation.checkpoint = dict(
+            counter=counter,
+            until=until,
+            position=position,
+            layers=self.dump_layers(component_layers),
+            random=self.get_random_state(),
+            sampler_file=sampler_file,
+            last_id=self.writer.last_id,
+        )
+        self.collection_operation.updated_date = datetime.datetime.utcnow()
+        self.collection_operation.save()
+
+        # drop the old state only once the new checkpoint points elsewhere
+        if previous_file:
+            models.CollectionOperation.delete_checkpoint_data(previous_file)
+
+        print("checkpoint", counter + position, "of", until)
+
+        if self.progress:
+            elapsed = time.perf_counter() - started
+            self.progress.add("checkpoint", elapsed)
+            self.selected += elapsed
+
+    def rollback(self, last_id):
+        art_images = models.ArtImage.objects(command=self.collection_operation)
+        if last_id:
+            art_images = art_images.filter(id__gt=last_id)
+
+        art_images = list(art_images)
+        if not art_images:
+            return
+
+        trait_statistics.record_art_images(
+            self.collection_operation.collection, art_images, -1
+        )
+        for art_image in art_images:
+            if art_image.image:
+                art_image.image.delete()
+        models.ArtImage.objects(id__in=[ai.id for ai in art_images]).delete()
+
+        print("rolled back", len(art_images), "images past checkpoint")
+
+    def generate(self, counter, until, component_layers, position=0):
+        for slot in range(position, until - counter):
+            self.checkpoint(counter, until, slot, component_layers)
 
-        while counter < until:
             components = None
             ccomponents = []
             for i in range(self.MAX_TRY):
@@ -213,12 +506,12 @@ class SimpleImageGenerator:
                     components = prepair_components
                     break
 
-            counter += 1
+            image_id = counter + slot + 1
             if not components:
                 continue
 
-            print(f"normal-random -> create image {counter}")
-            self.create_image(counter, components)
+            print(f"normal-random -> create image {image_id}")
+            self.create_image(image_id, components)
 
             for c in ccomponents:
                 c["count"] += 1
@@ -231,22 +524,33 @@ class SimpleImageGenerator:
 
             component_layers[:] = [l for l in component_layers if l]
 
+    def restore(self):
+        state = self.collection_operation.checkpoint
+        self.rollback(state.get("last_id"))
 
-    def run(self):
-        print(
-            "Action",
-            self.collection_operation.submitted_date,
-            self.collection_operation.collection.name,
-            self.collection_operation.owner.first_name,
-        )
-        self.collection_operation.status = "prepair"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        component_layers = self.load_layers(state["layers"])
+        self.set_random_state(state["random"])
+        if state.get("sampler_file"):
+            self.sampler = samplers.ProductSampler(
+                [len(l) for l in component_layers], self.random
+            )
+            self.sampler.setstate(
+                models.CollectionOperation.read_checkpoint_data(state["sampler_file"])
+            )
+
+        self.writer.last_id = state.get("last_id")
+        self.resumed = True
+
+        return state["counter"], state["until"], state["position"], component_layers
+
+    def prepare(self):
+        started = time.perf_counter()
 
         component_class = self.collection_operation.parameters.get("generated_class")
         layers = self.get_component_quotas(component_class)
+        component_layers = [list(l.values()) for l in layers.values()]
 
-        possible_image = self.get_posible_image(layers)
+        possible_image = self.get_posible_image(component_layers)
 
         counter = models.ArtImage.objects(
             collection=self.collection_operation.collection
@@ -259,66 +563,109 @@ class SimpleImageGenerator:
         until = counter + amount
 
         print("=> start", counter, "to", until, "amount", amount)
+        print("prepare", f"{(time.perf_counter() - started) * 1000:.1f}ms")
+        return counter, until, 0, component_layers
 
-        self.collection_operation.status = "generate"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+    def complete(self):
+        progress.set_status(self.collection_operation, "trait-counting")
 
-        self.generate(counter, until, layers)
+        trait_statistics.refresh_rarity(self.collection_operation.collection)
 
-        self.collection_operation.status = "trait-counting"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        progress.set_status(self.collection_operation, "completed", completed=True)
 
-        self.count_trait()
+    def run(self, resume=False):
+        print(
+            "Action",
+            self.collection_operation.submitted_date,
+            self.collection_operation.collection.name,
+            self.collection_operation.owner.first_name,
+        )
+        self.collection_operation.parameters["seed"] = self.seed
+        progress.set_status(
+            self.collection_operation, "resuming" if resume else "prepair"
+        )
 
-        self.collection_operation.status = "completed"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.completed_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        if resume:
+            counter, until, position, component_layers = self.restore()
+            print("=> resume", counter + position, "to", until)
+        else:
+            counter, until, position, component_layers = self.prepare()
 
+        self.dna_index.load()
 
-class RandomAfterImageGenerator(SimpleImageGenerator):
-    def generate(self, counter, until, layers):
-        component_layers = []
-        for l in layers.values():
-            component_layers.append(list(l.values()))
+        progress.set_status(self.collection_operation, "generate")
 
-        sample_layers = [list(range(0, len(l))) for k, l in layers.items()]
+        base_keys = self.get_base_keys(component_layers, until - counter - position)
+        print("base layers", len(base_keys))
 
-        products = itertools.product(*sample_layers)
-        possible_components = list(products)
-        random.shuffle(possible_components)
+        self.pipeline = self.create_pipeline(component_layers, base_keys)
+        self.progress = progress.ProgressTracker(
+            self.collection_operation,
+            total=self.get_total(counter, until),
+            done=position,
+            stages=self.get_stage_times,
+        )
+        self.selected = time.perf_counter()
+        try:
+            self.generate(counter, until, component_layers, position)
+        finally:
+            try:
+                self.pipeline.close()
+            finally:
+                self.writer.flush()
+                self.progress.save(force=True)
+
+        stats = self.pipeline.stats()
+        encoded = max(stats.get("encode_count", 0), 1)
+        self.collection_operation.message["render"] = stats
+        self.collection_operation.message["encoder"] = dict(
+            format=self.renderer.encoder.format,
+            tokens=stats.get("encode_count", 0),
+            bytes_per_token=stats.get("encode_size", 0) / encoded,
+            ms_per_token=stats.get("encode_ms", 0) / encoded,
+        )
+        self.collection_operation.message["dna"] = dict(
+            tries=self.tries, rejected=self.rejected
+        )
+        print("render", stats)
+        print("encoder", self.collection_operation.message["encoder"])
+
+        self.complete()
 
-        for i in range(counter + 1, until + 1):
-            j = 0
-            while j < self.MAX_TRY:
-                # print("len", len(possible_components))
-                if len(possible_components) == 0:
-                    print("out of range", possible_components)
-                    return
+        # a completed run is never resumed, so its sampler state can go
+        sampler_file = self.collection_operation.checkpoint.get("sampler_file")
+        if sampler_file:
+            models.CollectionOperation.delete_checkpoint_data(sampler_file)
+            models.CollectionOperation.objects(
+                id=self.collection_operation.id
+            ).update_one(set__checkpoint__sampler_file=None)
 
-                random_components = random.choice(possible_components)
 
+class RandomAfterImageGenerator(SimpleImageGenerator):
+    def generate(self, counter, until, component_layers, position=0):
+        if self.sampler is None:
+            self.sampler = samplers.ProductSampler(
+                [len(l) for l in component_layers], self.random
+            )
+
+        for slot in range(position, until - counter):
+            self.checkpoint(counter, until, slot, component_layers)
+
+            i = counter + slot + 1
+            for random_components in self.sampler:
                 components = []
                 is_remove = False
                 for k, l in enumerate(random_components):
                     com = component_layers[k][l]
 
-                    # print("->c", com)
                     if com["count"] + 1 > com["quota"]:
-                        # print("over remove")
                         is_remove = True
                         break
 
                     if com["component"]:
                         components.append(com["component"])
 
-                # print("r", random_components)
-                # print("c", components)
                 if is_remove or not self.is_valide_dna(components):
-                    # print("remove")
-                    possible_components.remove(random_components)
                     continue
 
                 for k, l in enumerate(random_components):
@@ -327,47 +674,334 @@ class RandomAfterImageGenerator(SimpleImageGenerator):
 
                 print(f"random-after -> create image {i}")
                 self.create_image(i, components)
-                possible_components.remove(random_components)
                 break
+            else:
+                print("out of range", self.sampler.total)
+                return
+
+
+class QuotaPlannedImageGenerator(SimpleImageGenerator):
+    def plan(self, amount, component_layers):
+        columns = []
+        blanks = []
+        for l in component_layers:
+            columns.append([c["quota"] - c["count"] for c in l])
+            blank = [i for i, c in enumerate(l) if c["component"] is None]
+            blanks.append(blank[0] if blank else None)
+
+        def exists(row):
+            return self.dna_index.contains(
+                [
+                    component_layers[k][j]["component"]
+                    for k, j in enumerate(row)
+                    if component_layers[k][j]["component"]
+                ]
+            )
+
+        planner = samplers.QuotaPlanner(
+            columns, blanks, amount, exists=exists, rng=self.random
+        )
+        rows = planner.plan()
+
+        self.collection_operation.plan = dict(
+            layers=[
+                [str(c["component"].id) if c["component"] else None for c in l]
+                for l in component_layers
+            ],
+            slots=[list(row) for row in rows],
+            report=planner.report,
+        )
+        if not self.dry_run:
+            self.collection_operation.save()
+
+        print("quota plan", planner.report)
+        return rows
+
+    def get_rows(self, counter, until, component_layers):
+        if self.resumed:
+            return [tuple(row) for row in self.collection_operation.plan["slots"]]
+
+        return self.plan(until - counter, component_layers)
+
+    def get_order(self, rows):
+        return sorted(range(len(rows)), key=lambda i: rows[i])
+
+    def generate(self, counter, until, component_layers, position=0):
+        rows = self.get_rows(counter, until, component_layers)
+
+        # render in DNA order so shared lower layers are composited once,
+        # token ids keep the shuffled plan order
+        order = self.get_order(rows)
+        for slot in range(position, len(order)):
+            self.checkpoint(counter, until, slot, component_layers)
+
+            index = order[slot]
+            components = []
+            for k, j in enumerate(rows[index]):
+                com = component_layers[k][j]
+                com["count"] += 1
+                if com["component"]:
+                    components.append(com["component"])
+
+            print(f"quota-exact -> create image {counter + index + 1}")
+            self.create_image(counter + index + 1, components)
+
+
+class ShardedImageGenerator(QuotaPlannedImageGenerator):
+    """Plan the whole run once, then hand token ranges of the plan to shards."""
+
+    def run(self, resume=False):
+        if resume:
+            raise Exception("sharded runs are resumed shard by shard")
+
+        self.collection_operation.parameters["seed"] = self.seed
+        progress.set_status(self.collection_operation, "prepair")
+
+        counter, until, position, component_layers = self.prepare()
+        self.dna_index.load()
+
+        rows = self.plan(until - counter, component_layers)
+        self.collection_operation.plan["counter"] = counter
+
+        shards = self.collection_operation.parameters.get("shards", 1)
+        size = max(math.ceil(len(rows) / shards), 1)
+
+        children = []
+        for index, start in enumerate(range(0, len(rows), size)):
+            stop = min(start + size, len(rows))
+            child = models.CollectionOperation(
+                command_type="generate-shard",
+                owner=self.collection_operation.owner,
+                collection=self.collection_operation.collection,
+                amount=stop - start,
+                submitted_date=datetime.datetime.utcnow(),
+                parameters=dict(
+                    self.collection_operation.parameters,
+                    parent=str(self.collection_operation.id),
+                    shard=index,
+                    start=start,
+                    stop=stop,
+                ),
+            )
+            child.save()
+            children.append(child)
+
+        self.collection_operation.message = dict(
+            generated=0,
+            total=len(rows),
+            shards=len(children),
+            shards_completed=0,
+            shards_progress={str(index): 0 for index in range(len(children))},
+            operations=[str(child.id) for child in children],
+        )
+        progress.set_status(self.collection_operation, "fan-out")
+
+        print("fan out", len(rows), "images to", len(children), "shards")
+
+        if not children:
+            fan_in(self.collection_operation)
+            return
 
+        for child in children:
+            job = redis_rq.redis_queue.queue.enqueue(
+                generate_shard,
+                args=(child,),
+                job_id=f"collection_operation_{child.id}",
+                timeout=600,
+                job_timeout=21600,
+            )
+            progress.set_status(child, job.get_status())
+
+
+class ShardImageGenerator(QuotaPlannedImageGenerator):
+    """Render one token range of a plan made by ShardedImageGenerator."""
+
+    def __init__(self, collection_operation):
+        super().__init__(collection_operation)
 
+        parameters = collection_operation.parameters
+        self.parent = models.CollectionOperation.objects(
+            id=parameters["parent"]
+        ).first()
+        self.shard = parameters["shard"]
+        self.start = parameters["start"]
+        self.stop = parameters["stop"]
+        self.reported = self.parent.message.get("shards_progress", {}).get(
+            str(self.shard), 0
+        )
+
+    def prepare(self):
+        plan = self.parent.plan
+        component_layers = self.load_layers(
+            [[[component_id, 0, 0] for component_id in l] for l in plan["layers"]]
+        )
+
+        counter = plan["counter"]
+        until = counter + len(plan["slots"])
+
+        print("=> shard", self.shard, "slots", self.start, "to", self.stop)
+        return counter, until, 0, component_layers
+
+    def get_rows(self, counter, until, component_layers):
+        return [tuple(row) for row in self.parent.plan["slots"]]
+
+    def get_total(self, counter, until):
+        return self.stop - self.start
+
+    def get_order(self, rows):
+        return sorted(range(self.start, self.stop), key=lambda i: rows[i])
+
+    def report_progress(self, done):
+        # absolute per shard progress keeps the aggregate right across resumes
+        models.CollectionOperation.objects(id=self.parent.id).update_one(
+            **{
+                f"set__message__shards_progress__{self.shard}": done,
+                "inc__message__generated": done - self.reported,
+                "set__updated_date": datetime.datetime.utcnow(),
+            }
+        )
+        self.reported = done
+        progress.publish(self.parent, "shard", shard=self.shard, done=done)
+
+    def checkpoint(self, counter, until, position, component_layers):
+        super().checkpoint(counter, until, position, component_layers)
+
+        if position % self.checkpoint_interval == 0:
+            self.report_progress(position)
+
+    def complete(self):
+        self.report_progress(self.stop - self.start)
+
+        progress.set_status(self.collection_operation, "completed", completed=True)
+
+        # the last shard to finish enqueues the fan in, this also covers
+        # shards that were resumed after a failure
+        parent = models.CollectionOperation.objects(id=self.parent.id).modify(
+            inc__message__shards_completed=1, new=True
+        )
+        if parent.message["shards_completed"] != parent.message["shards"]:
+            return
+
+        print("all shards completed", parent.id)
+        job = redis_rq.redis_queue.queue.enqueue(
+            fan_in,
+            args=(parent,),
+            job_id=f"collection_operation_{parent.id}_fan_in",
+            timeout=600,
+            job_timeout=21600,
+        )
+        print("fan in", job.get_status())
+
+
+GENERATORS = {
+    "normal-random": SimpleImageGenerator,
+    "random-after": RandomAfterImageGenerator,
+    "quota-exact": QuotaPlannedImageGenerator,
+}
+
+# shards take token ranges of one plan, only planned generators can split
+SHARDED_GENERATORS = ["quota-exact"]
+
+
+@progress.report_failure
 def generate(collection_operation):
     print("Random with", collection_operation.parameters.get("generated_type"))
 
-    operation = None
-    generated_type = collection_operation.parameters.get("generated_type")
-    if generated_type == "normal-random":
-        operation = SimpleImageGenerator(collection_operation)
-    if generated_type == "random-after":
-        operation = RandomAfterImageGenerator(collection_operation)
+    parameters = collection_operation.parameters
+    if parameters.get("shards", 1) > 1:
+        if parameters.get("generated_type") not in SHARDED_GENERATORS:
+            raise Exception(
+                f"generated type {parameters.get('generated_type')} cannot be sharded"
+            )
+
+        ShardedImageGenerator(collection_operation).run()
+        return
+
+    generator_class = GENERATORS.get(
+        collection_operation.parameters.get("generated_type")
+    )
+    if generator_class:
+        generator_class(collection_operation).run()
+
+
+def run_shard(collection_operation, resume=False):
+    operation = ShardImageGenerator(collection_operation)
+    try:
+        operation.run(resume=resume)
+    except Exception as e:
+        # the parent cannot fan in without this shard
+        progress.fail(operation.parent, e)
+        raise
+
+
+@progress.report_failure
+def generate_shard(collection_operation):
+    print("Shard", collection_operation.parameters.get("shard"))
+
+    run_shard(collection_operation)
+
+
+@progress.report_failure
+def fan_in(collection_operation):
+    progress.set_status(collection_operation, "trait-counting")
 
-    if operation:
-        operation.run()
+    trait_statistics.count_trait(collection_operation.collection)
 
+    progress.set_status(collection_operation, "completed", completed=True)
 
+
+@progress.report_failure
+def resume(collection_operation):
+    print("Resume with", collection_operation.parameters.get("generated_type"))
+
+    if collection_operation.command_type == "generate-shard":
+        run_shard(collection_operation, resume=True)
+        return
+
+    generator_class = GENERATORS.get(
+        collection_operation.parameters.get("generated_type")
+    )
+    if generator_class:
+        generator_class(collection_operation).run(resume=True)
+
+
+@progress.report_failure
 def count_trait(collection_operation):
     operation = SimpleImageGenerator(collection_operation)
-    collection_operation.status = "trait-counting"
-    collection_operation.updated_date = datetime.datetime.utcnow()
-    collection_operation.save()
+    progress.set_status(collection_operation, "trait-counting")
 
     operation.count_trait()
 
-    collection_operation.status = "completed"
-    collection_operation.updated_date = datetime.datetime.utcnow()
-    collection_operation.completed_date = datetime.datetime.utcnow()
-    collection_operation.save()
+    progress.set_status(collection_operation, "completed", completed=True)
+
+
+@progress.report_failure
+def backfill_bbox(collection_operation):
+    progress.set_status(collection_operation, "bbox-backfilling")
+
+    image_layers = models.ImageLayer.objects(collection=collection_operation.collection)
+    component_images = models.ComponentImage.objects(image_layer__in=image_layers)
+
+    counter = 0
+    for component_image in component_images:
+        if not component_image.image:
+            continue
+        if component_image.bbox and not component_image.has_full_crop():
+            continue
+
+        component_image.update_bbox()
+        component_image.save()
+        counter += 1
+
+    collection_operation.amount = counter
+    progress.set_status(collection_operation, "completed", completed=True)
 
 
+@progress.report_failure
 def shake_token_id(collection_operation):
     operation = SimpleImageGenerator(collection_operation)
-    collection_operation.status = "shaking-token-id"
-    collection_operation.updated_date = datetime.datetime.utcnow()
-    collection_operation.save()
+    progress.set_status(collection_operation, "shaking-token-id")
 
     operation.shake_token_id()
 
-    collection_operation.status = "completed"
-    collection_operation.updated_date = datetime.datetime.utcnow()
-    collection_operation.completed_date = datetime.datetime.utcnow()
-    collection_operation.save()
+    progress.set_status(collection_operation, "completed", completed=True)
@@ -0,0 +1,102 @@
+import io
+
+from PIL import Image
+
+from app import models
+from app.api.utils import renderers
+from app.api.jobs import art_generator, progress
+
+
+class PreviewLayerLoader:
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, component_id, cropped=False):
+        data, offset = models.ComponentImage.load_layer(component_id)
+        img, alpha = renderers.open_image(data)
+        img = img.resize(
+            (
+                max(round(img.width * self.scale), 1),
+                max(round(img.height * self.scale), 1),
+            ),
+            Image.BILINEAR,
+        )
+
+        # crop after scaling so offsets stay aligned with the scaled base
+        if cropped:
+            bbox = renderers.get_alpha_bbox(img)
+            if not bbox:
+                return None, None
+
+            img = img.crop(bbox)
+            offset = bbox[:2]
+        elif not alpha:
+            img = img.convert("RGB")
+
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format="PNG", compress_level=0)
+        return img_bytes.getvalue(), offset
+
+
+def save_previews(collection_operation, items, results):
+    previews = []
+    for (image_id, components), (_, data) in zip(items, results):
+        img = Image.open(io.BytesIO(data))
+        previews.append(
+            models.PreviewImage(
+                collection=collection_operation.collection,
+                command=collection_operation,
+                components=components,
+                token_id=image_id,
+                data=data,
+                width=img.width,
+                height=img.height,
+            )
+        )
+
+    if previews:
+        models.PreviewImage.objects.insert(previews, load_bulk=False)
+
+
+@progress.report_failure
+def generate_preview(collection_operation):
+    progress.set_status(collection_operation, "preview")
+
+    parameters = collection_operation.parameters
+    generated_type = parameters.get("generated_type")
+
+    generator_class = art_generator.GENERATORS.get(generated_type)
+    if not generator_class:
+        raise Exception(f"generated type {generated_type} not found")
+
+    # pick the same dna a real run would, without storing art images
+    generator = generator_class(collection_operation)
+    generator.dry_run = True
+
+    counter, until, position, component_layers = generator.prepare()
+    generator.dna_index.load(backfill=False)
+    generator.generate(counter, until, component_layers, position)
+
+    scale = parameters.get("preview_scale", 0.25)
+    renderer = renderers.get_renderer(
+        generator.compositor,
+        PreviewLayerLoader(scale),
+        generator.cache_size,
+        generator.prefix_cache_size,
+        dict(format="png", compress_level=1),
+    )
+
+    batch_size = parameters.get("batch_size", 100)
+    items = generator.dry_images
+    for i in range(0, len(items), batch_size):
+        chunk = items[i : i + batch_size]
+        results = renderer.render_many(
+            [(image_id, [c.id for c in components]) for image_id, components in chunk]
+        )
+        save_previews(collection_operation, chunk, results)
+
+    print("preview", len(items), "images at scale", scale, renderer.stats())
+
+    collection_operation.amount = len(items)
+    collection_operation.message["render"] = renderer.stats()
+    progress.set_status(collection_operation, "completed", completed=True)
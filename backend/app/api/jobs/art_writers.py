@@ -0,0 +1,93 @@
+import datetime
+import io
+import time
+
+from bson import Binary, ObjectId
+from PIL import Image
+
+from app import models
+from app.api.jobs import trait_statistics
+
+DEFAULT_CHUNK_SIZE = 255 * 1024
+
+
+class BulkArtImageWriter:
+    def __init__(self, batch_size=100, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+
+        db = models.ArtImage._get_db()
+        bucket = models.ArtImage._fields["image"].collection_name
+        self.files = db[f"{bucket}.files"]
+        self.chunks = db[f"{bucket}.chunks"]
+        self.documents = models.ArtImage._get_collection()
+
+        self.items = []
+        self.written = 0
+        self.last_id = None
+        self.time = 0
+
+    def add(self, art_image, data, filename, content_type):
+        self.items.append((art_image, data, filename, content_type))
+
+        if len(self.items) >= self.batch_size:
+            self.flush()
+
+    def get_file_document(self, file_id, data, filename, content_type):
+        img = Image.open(io.BytesIO(data))
+        return {
+            "_id": file_id,
+            "length": len(data),
+            "chunkSize": self.chunk_size,
+            "uploadDate": datetime.datetime.utcnow(),
+            "filename": filename,
+            "contentType": content_type,
+            "width": img.width,
+            "height": img.height,
+            "format": img.format,
+            # ImageGridFsProxy.delete reads it to drop the thumbnail
+            "thumbnail_id": None,
+        }
+
+    def get_chunk_documents(self, file_id, data):
+        return [
+            {"files_id": file_id, "n": n, "data": Binary(data[i : i + self.chunk_size])}
+            for n, i in enumerate(range(0, len(data), self.chunk_size))
+        ]
+
+    def flush(self):
+        if not self.items:
+            return
+
+        items, self.items = self.items, []
+        started = time.perf_counter()
+
+        files = []
+        chunks = []
+        for art_image, data, filename, content_type in items:
+            if data is None:
+                # render-on-demand, only the dna and render spec are stored
+                art_image.validate()
+                continue
+
+            file_id = ObjectId()
+            files.append(self.get_file_document(file_id, data, filename, content_type))
+            chunks.extend(self.get_chunk_documents(file_id, data))
+            art_image.image.grid_id = file_id
+            art_image.validate()
+
+        if chunks:
+            self.chunks.insert_many(chunks, ordered=False)
+        if files:
+            self.files.insert_many(files, ordered=False)
+
+        art_images = [item[0] for item in items]
+        result = self.documents.insert_many([ai.to_mongo() for ai in art_images])
+        for art_image, inserted_id in zip(art_images, result.inserted_ids):
+            art_image.id = inserted_id
+        self.last_id = result.inserted_ids[-1]
+
+        trait_statistics.record_art_images(art_images[0].collection, art_images)
+
+        self.written += len(items)
+        self.time += time.perf_counter() - started
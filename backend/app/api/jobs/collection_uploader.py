@@ -1,7 +1,8 @@
 import requests
 import json
-import datetime
 from app.api.utils import metadata_generators
+from app.api.jobs import progress
+from app import models
 
 
 class PinataUploader:
@@ -13,18 +14,24 @@ class PinataUploader:
     def get_files(self):
         files = []
         collection = self.collection_operation.collection
-        for art_image in collection.get_art_images():
-            image = art_image.image
+        renderer = models.ArtImage.get_renderer()
+        art_images = collection.get_art_images()
+        self.progress.total = art_images.count()
+        for art_image in art_images:
+            with self.progress.stage("fetch"):
+                data = art_image.read_image(renderer)
+
             files.append(
                 (
                     "file",
                     (
-                        f"{collection.name}/{image.filename}",
-                        image.read(),
-                        image.content_type,
+                        f"{collection.name}/{art_image.filename}",
+                        data,
+                        art_image.content_type,
                     ),
                 )
             )
+            self.progress.advance()
         return files
 
     def get_metadata(self):
@@ -33,9 +40,10 @@ class PinataUploader:
 
         collection = self.collection_operation.collection
         for art_image in collection.get_art_images():
-            filename = art_image.image.filename.split(".")[0]
+            filename = art_image.filename.split(".")[0]
 
-            metadata = metadata_gernerator.compose(art_image)
+            with self.progress.stage("metadata"):
+                metadata = metadata_gernerator.compose(art_image)
             files.append(
                 (
                     "file",
@@ -69,9 +77,11 @@ class PinataUploader:
 
         files = self.get_files()
 
-        response: requests.Response = requests.post(
-            url=self.pin_file_url, files=files, headers=headers
-        )
+        with self.progress.stage("upload"):
+            response: requests.Response = requests.post(
+                url=self.pin_file_url, files=files, headers=headers
+            )
+        self.progress.save(force=True)
 
         data = response.json()
 
@@ -90,9 +100,11 @@ class PinataUploader:
 
         files = self.get_metadata()
 
-        response: requests.Response = requests.post(
-            url=self.pin_file_url, files=files, headers=headers
-        )
+        with self.progress.stage("metadata upload"):
+            response: requests.Response = requests.post(
+                url=self.pin_file_url, files=files, headers=headers
+            )
+        self.progress.save(force=True)
 
         data = response.json()
 
@@ -104,27 +116,22 @@ class PinataUploader:
         print("upload metadata complete cid:", collection.file_json_token_cid)
 
     def run(self):
+        self.progress = progress.ProgressTracker(self.collection_operation)
 
-        self.collection_operation.status = "image uploading"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        progress.set_status(self.collection_operation, "image uploading")
 
         print("upload image collection", self.collection_operation.id)
         self.upload()
 
-        self.collection_operation.status = "metadata uploading"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        progress.set_status(self.collection_operation, "metadata uploading")
 
         print("upload json collection", self.collection_operation.id)
         self.upload_metadata()
 
-        self.collection_operation.status = "completed"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.completed_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        progress.set_status(self.collection_operation, "completed", completed=True)
 
 
+@progress.report_failure
 def upload(collection_operation):
     uploader = None
     if collection_operation.collection.file_host == "pinata":
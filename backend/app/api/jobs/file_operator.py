@@ -1,11 +1,13 @@
-import requests
 import json
-import datetime
 import pathlib
+import shutil
 import zipfile
-from app.api.utils import metadata_generators
+from app.api.jobs import progress
 from app import models
 
+# matches the gridfs chunk size so every read is a single chunk
+CHUNK_SIZE = 255 * 1024
+
 
 class FileOperator:
     def __init__(self, collection_operation, data_path="/tmp/hermes"):
@@ -16,76 +18,74 @@ class FileOperator:
         if not self.working_path.exists():
             self.working_path.mkdir(parents=True, exist_ok=True)
 
-    def create_temporary(self):
-
-        self.collection_path = self.working_path / str(
-            self.collection_operation.collection.id
+        self.archive_path = (
+            self.working_path / f"{self.collection_operation.collection.id}.zip"
+        )
+        # build aside and rename so downloads never see a partial archive
+        self.temporary_path = self.archive_path.with_name(
+            f"{self.archive_path.name}.{self.collection_operation.id}.tmp"
         )
-        if not self.collection_path.exists():
-            self.collection_path.mkdir(parents=True, exist_ok=True)
-
-        collection_archive = pathlib.Path(f"{self.collection_path}.zip")
-        if collection_archive.exists():
-            collection_archive.unlink(missing_ok=True)
-
-    def remove_temporary(self):
-        if self.collection_path.exists():
-            for file in self.collection_path.iterdir():
-                file.unlink(missing_ok=True)
 
-            self.collection_path.rmdir()
+    def get_zip_info(self, art_image, name, compress_type):
+        zip_info = zipfile.ZipInfo(name, art_image.created_date.timetuple()[:6])
+        zip_info.compress_type = compress_type
+        return zip_info
+
+    def write_image(self, archive, art_image, renderer):
+        with self.progress.stage("fetch"):
+            image = art_image.open_image(renderer)
+
+        # png and webp are already compressed, store them as they are
+        zip_info = self.get_zip_info(art_image, art_image.filename, zipfile.ZIP_STORED)
+        with self.progress.stage("write"):
+            with archive.open(zip_info, mode="w") as f:
+                shutil.copyfileobj(image, f, CHUNK_SIZE)
+
+    def write_metadata(self, archive, art_image):
+        with self.progress.stage("metadata"):
+            metadata = json.dumps(art_image.metadata)
+
+        zip_info = self.get_zip_info(
+            art_image,
+            f"{art_image.filename.split('.')[0]}.json",
+            zipfile.ZIP_DEFLATED,
+        )
+        with self.progress.stage("write"):
+            archive.writestr(zip_info, metadata)
 
-    def prepair_art_file(self):
+    def create_zip_file(self):
         art_images = models.ArtImage.objects(
             collection=self.collection_operation.collection
         )
-        for art_image in art_images:
-            with open(f"{self.collection_path}/{art_image.image.filename}", "wb") as f:
-                f.write(art_image.image.read())
-            with open(
-                f"{self.collection_path}/{art_image.image.filename.split('.')[0]}.json",
-                "w",
-            ) as f:
-                f.write(json.dumps(art_image.metadata))
+        renderer = models.ArtImage.get_renderer()
+        self.progress.total = art_images.count()
 
-    def create_zip_file(self):
-        with zipfile.ZipFile(f"{self.collection_path}.zip", mode="w") as archive:
-            for file in self.collection_path.iterdir():
-                archive.write(file, arcname=file.name)
-
-    def run(self):
-
-        self.collection_operation.status = "file prepairation"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        try:
+            with zipfile.ZipFile(self.temporary_path, mode="w") as archive:
+                # no_cache keeps memory flat however large the collection is
+                for art_image in art_images.no_cache():
+                    self.write_image(archive, art_image, renderer)
+                    self.write_metadata(archive, art_image)
+                    self.progress.advance()
 
-        self.create_temporary()
+            self.temporary_path.replace(self.archive_path)
+        finally:
+            self.temporary_path.unlink(missing_ok=True)
 
-        print("prepair image collection", self.collection_operation.id)
-        self.prepair_art_file()
+        self.progress.save(force=True)
 
-        # self.collection_operation.status = "json prepairation"
-        # self.collection_operation.updated_date = datetime.datetime.utcnow()
-        # self.collection_operation.save()
-
-        # print("prepair json collection", self.collection_operation.id)
-        # self.prepair_json_file()
+    def run(self):
+        self.progress = progress.ProgressTracker(self.collection_operation)
 
-        self.collection_operation.status = "create archive"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        progress.set_status(self.collection_operation, "create archive")
 
         print("create zip file", self.collection_operation.id)
         self.create_zip_file()
 
-        self.remove_temporary()
-
-        self.collection_operation.status = "completed"
-        self.collection_operation.updated_date = datetime.datetime.utcnow()
-        self.collection_operation.completed_date = datetime.datetime.utcnow()
-        self.collection_operation.save()
+        progress.set_status(self.collection_operation, "completed", completed=True)
 
 
+@progress.report_failure
 def create_archive(collection_operation, data_path):
     operator = FileOperator(collection_operation, data_path)
     operator.run()
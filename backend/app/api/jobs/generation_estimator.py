@@ -0,0 +1,165 @@
+import math
+import time
+
+from app.api.jobs import art_generator
+
+# slots walked by a dry run, larger runs are extrapolated from them
+SIMULATE_LIMIT = 1000
+
+
+def get_layer_report(components, amount):
+    names = [c["component"].image_layer.name for c in components if c["component"]]
+    quota = sum(max(c["quota"] - c["count"], 0) for c in components)
+    has_blank = any(c["component"] is None for c in components)
+
+    padded = max(amount - quota, 0)
+    trimmed = max(quota - amount, 0)
+
+    return dict(
+        name=names[0] if names else None,
+        options=len(components),
+        quota=quota,
+        padded=padded,
+        trimmed=trimmed,
+        # a blank option can absorb missing quota, real options cannot
+        satisfiable=trimmed == 0 and (padded == 0 or has_blank),
+    )
+
+
+def render_sample(generator, images, sample_size):
+    sample = images[:sample_size]
+    if not sample:
+        return 0, 0
+
+    tasks = [(image_id, [c.id for c in components]) for image_id, components in sample]
+
+    started = time.perf_counter()
+    results = generator.renderer.render_many(tasks)
+    elapsed = time.perf_counter() - started
+
+    size = sum(len(data) for image_id, data in results)
+    return elapsed * 1000 / len(results), size / len(results)
+
+
+def get_occupancy_rejection(combinations, existing, amount):
+    """Expected share of uniform draws that hit a combination already used.
+
+    Drawing k unique out of N free combinations takes about
+    N * (H(N) - H(N - k)) tries, with H the harmonic number.
+    """
+    free = combinations - existing
+    count = min(amount, free)
+    if count <= 0:
+        return 0
+
+    def harmonic(n):
+        if n <= 0:
+            return 0
+        return math.log(n) + 0.5772156649 + 1 / (2 * n)
+
+    tries = combinations * (harmonic(free) - harmonic(free - count))
+    return max(1 - count / tries, 0) if tries > 0 else 0
+
+
+def simulate_plan(generator, counter, amount, component_layers, simulate_limit):
+    # the plan covers every slot exactly, only its first slots are kept
+    rows = generator.plan(amount, component_layers)
+
+    images = []
+    for index, row in enumerate(rows[:simulate_limit]):
+        components = [
+            component_layers[k][j]["component"]
+            for k, j in enumerate(row)
+            if component_layers[k][j]["component"]
+        ]
+        images.append((counter + index + 1, components))
+
+    return images, amount - len(rows), 0
+
+
+def simulate_draws(generator, counter, amount, component_layers, simulate_limit):
+    slots = min(amount, simulate_limit)
+    generator.generate(counter, counter + slots, component_layers)
+
+    images = generator.dry_images
+    skipped = (slots - len(images)) * amount / slots if slots else 0
+    rejection_rate = generator.rejected / max(generator.tries, 1)
+    return images, round(skipped), rejection_rate
+
+
+def estimate(collection_operation, sample_size=8, simulate_limit=SIMULATE_LIMIT):
+    parameters = collection_operation.parameters
+
+    generated_type = parameters.get("generated_type")
+
+    generator_class = art_generator.GENERATORS.get(generated_type)
+    if not generator_class:
+        raise Exception(f"generated type {generated_type} not found")
+
+    generator = generator_class(collection_operation)
+    generator.dry_run = True
+
+    counter, until, position, component_layers = generator.prepare()
+    amount = until - counter
+
+    combinations = (
+        math.prod(len(l) for l in component_layers) if component_layers else 0
+    )
+    layers = [get_layer_report(l, amount) for l in component_layers]
+
+    generator.dna_index.load(backfill=False)
+    existing = len(generator.dna_index.hashes)
+
+    # a bounded simulation keeps the request short whatever the amount
+    started = time.perf_counter()
+    if isinstance(generator, art_generator.QuotaPlannedImageGenerator):
+        simulate = simulate_plan
+    else:
+        simulate = simulate_draws
+    images, skipped, rejection_rate = simulate(
+        generator, counter, amount, component_layers, simulate_limit
+    )
+    simulate_ms = (time.perf_counter() - started) * 1000
+
+    extrapolated = len(images) + skipped < amount
+    sampled = isinstance(generator, art_generator.RandomAfterImageGenerator)
+    if extrapolated and simulate is simulate_draws and not sampled:
+        # early draws rarely collide, later ones meet a fuller space
+        rejection_rate = max(
+            rejection_rate, get_occupancy_rejection(combinations, existing, amount)
+        )
+
+    generated = amount - skipped
+    ms_per_image, bytes_per_image = render_sample(generator, images, sample_size)
+    workers = parameters.get("workers", 1)
+
+    plan = collection_operation.plan.get("report", {})
+    feasible = (
+        amount == collection_operation.amount
+        and skipped == 0
+        and all(l["satisfiable"] for l in layers)
+        and not plan.get("unresolved")
+    )
+
+    return dict(
+        requested=collection_operation.amount,
+        amount=amount,
+        combinations=combinations,
+        existing=existing,
+        layers=layers,
+        plan=plan,
+        simulated=len(images),
+        extrapolated=extrapolated,
+        skipped=skipped,
+        simulate_ms=simulate_ms,
+        tries=generator.tries,
+        rejected=generator.rejected,
+        rejection_rate=rejection_rate,
+        sample=min(sample_size, len(images)),
+        ms_per_image=ms_per_image,
+        bytes_per_image=bytes_per_image,
+        estimated_render_seconds=ms_per_image * generated / 1000 / max(workers, 1),
+        estimated_bytes=int(bytes_per_image * generated),
+        render_mode=generator.render_mode,
+        feasible=feasible,
+    )
@@ -0,0 +1,115 @@
+import collections
+import contextlib
+import datetime
+import functools
+import time
+
+from app import models
+from app.api import redis_rq
+
+
+def publish(collection_operation, event, **data):
+    redis_rq.redis_queue.publish(
+        collection_operation.id,
+        dict(id=str(collection_operation.id), event=event, **data),
+    )
+
+
+def set_status(collection_operation, status, completed=False):
+    now = datetime.datetime.utcnow()
+    collection_operation.status = status
+    collection_operation.updated_date = now
+    if completed:
+        collection_operation.completed_date = now
+    collection_operation.save()
+
+    publish(collection_operation, "status", status=status, updated_date=now)
+
+
+def fail(collection_operation, error):
+    try:
+        collection_operation.message["error"] = str(error)
+        set_status(collection_operation, "failed")
+    except Exception as e:
+        print("cannot report failure", collection_operation.id, e)
+
+
+def report_failure(job):
+    """Set the operation failed when its job raises, so watchers stop waiting."""
+
+    @functools.wraps(job)
+    def wrapper(collection_operation, *args, **kwargs):
+        try:
+            return job(collection_operation, *args, **kwargs)
+        except Exception as e:
+            fail(collection_operation, e)
+            raise
+
+    return wrapper
+
+
+class ProgressTracker:
+    """Keep done/total, rate, eta and stage timings in message.progress.
+
+    Saves go straight to the database with $set at most every ``interval``
+    seconds, so the tracker can run next to the job's own saves and from the
+    image writer thread.
+    """
+
+    def __init__(self, collection_operation, total=0, done=0, interval=2, stages=None):
+        self.collection_operation = collection_operation
+        self.total = total
+        self.done = done
+        self.initial = done
+        self.interval = interval
+        self.get_stages = stages
+
+        self.stages = collections.defaultdict(float)
+        self.started = time.perf_counter()
+        self.saved = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+    def add(self, name, seconds):
+        self.stages[name] += seconds
+
+    def advance(self, count=1):
+        self.done += count
+        self.save()
+
+    def get_data(self):
+        elapsed = time.perf_counter() - self.started
+        rate = (self.done - self.initial) / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.done) / rate if rate > 0 else None
+
+        stages = dict(self.stages)
+        if self.get_stages:
+            stages.update(self.get_stages())
+
+        return dict(
+            done=self.done,
+            total=self.total,
+            rate=rate,
+            eta_seconds=eta,
+            elapsed_seconds=elapsed,
+            stages={k: round(v, 3) for k, v in stages.items()},
+        )
+
+    def save(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.saved < self.interval:
+            return
+
+        self.saved = now
+        data = self.get_data()
+        models.CollectionOperation.objects(id=self.collection_operation.id).update_one(
+            set__message__progress=data,
+            set__updated_date=datetime.datetime.utcnow(),
+        )
+        publish(self.collection_operation, "progress", progress=data)
@@ -0,0 +1,167 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+
+from app.api.utils import renderers
+
+
+class ArtImageWriter(threading.Thread):
+    def __init__(self, save_image, max_size):
+        super().__init__(daemon=True)
+        self.save_image = save_image
+        self.queue = queue.Queue(maxsize=max_size)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            try:
+                if not self.error:
+                    self.save_image(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def put(self, image_id, components, data):
+        if self.error:
+            raise self.error
+
+        self.queue.put((image_id, components, data))
+
+    def flush(self):
+        self.queue.join()
+
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+        if self.error:
+            raise self.error
+
+
+def get_tasks(chunk):
+    return [(image_id, [c.id for c in components]) for image_id, components in chunk]
+
+
+class SerialRenderPipeline:
+    def __init__(self, renderer, save_image, chunk_size=16):
+        self.renderer = renderer
+        self.save_image = save_image
+        self.chunk_size = chunk_size
+
+        self.chunk = []
+
+    def submit(self, image_id, components):
+        self.chunk.append((image_id, components))
+        if len(self.chunk) >= self.chunk_size:
+            self.dispatch()
+
+    def dispatch(self):
+        chunk, self.chunk = self.chunk, []
+        results = self.renderer.render_many(get_tasks(chunk))
+
+        for (image_id, data), (_, components) in zip(results, chunk):
+            self.save_image(image_id, components, data)
+
+    def stats(self):
+        return self.renderer.stats()
+
+    def flush(self):
+        if self.chunk:
+            self.dispatch()
+
+    def close(self):
+        self.flush()
+
+
+class ProcessRenderPipeline:
+    def __init__(
+        self,
+        save_image,
+        layer_images,
+        cache_size,
+        workers,
+        compositor="pillow",
+        prefix_cache_size=0,
+        base_keys=None,
+        encoder=None,
+        chunk_size=16,
+    ):
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=renderers.init_worker,
+            initargs=(
+                layer_images,
+                cache_size,
+                compositor,
+                prefix_cache_size,
+                base_keys,
+                encoder,
+            ),
+        )
+        self.writer = ArtImageWriter(save_image, max_size=workers * chunk_size * 2)
+        self.writer.start()
+
+        self.chunk = []
+        self.pending = collections.deque()
+        self.worker_stats = {}
+
+    def submit(self, image_id, components):
+        self.chunk.append((image_id, components))
+        if len(self.chunk) >= self.chunk_size:
+            self.dispatch()
+
+    def dispatch(self):
+        if not self.chunk:
+            return
+
+        future = self.executor.submit(renderers.render_worker, get_tasks(self.chunk))
+        self.pending.append((future, self.chunk))
+        self.chunk = []
+
+        while len(self.pending) > self.workers * 2:
+            self.collect()
+
+    def collect(self):
+        future, chunk = self.pending.popleft()
+        pid, results, stats = future.result()
+        self.worker_stats[pid] = stats
+
+        for (image_id, data), (_, components) in zip(results, chunk):
+            self.writer.put(image_id, components, data)
+
+    def stats(self):
+        data = dict(workers=len(self.worker_stats))
+        # the writer thread reads stats while collect() adds workers
+        for stats in list(self.worker_stats.values()):
+            for k, v in stats.items():
+                data[k] = data.get(k, 0) + v
+
+        return data
+
+    def flush(self):
+        self.dispatch()
+        while self.pending:
+            self.collect()
+
+        self.writer.flush()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.writer.close()
@@ -0,0 +1,223 @@
+import collections
+
+from pymongo import UpdateOne
+
+from app import models
+from app.api import redis_rq
+
+
+def get_reference_id(value):
+    return getattr(value, "id", value)
+
+
+def count_component_usage(collection):
+    pipeline = [
+        {"$unwind": "$components"},
+        {"$group": {"_id": "$components", "count": {"$sum": 1}}},
+    ]
+    art_images = models.ArtImage.objects(collection=collection)
+
+    return {
+        get_reference_id(data["_id"]): data["count"]
+        for data in art_images.aggregate(pipeline)
+    }
+
+
+def get_component_ids(collection):
+    image_layers = models.ImageLayer.objects(collection=collection)
+    return models.ComponentImage.objects(image_layer__in=image_layers).distinct("id")
+
+
+def update_component_rarity(statistic, total_image, total=None):
+    if total is None:
+        total = sum(statistic.values())
+
+    rarities = {}
+    updates = []
+    for component_id, v in statistic.items():
+        rarity = 0
+        rarity_percent = 0
+        if v > 0:
+            rarity = 1 / (v / total)
+        if v > 0 and total_image > 0:
+            rarity_percent = v / total_image * 100
+        rarities[component_id] = (rarity, rarity_percent)
+        updates.append(
+            UpdateOne(
+                {"_id": component_id},
+                {
+                    "$set": {
+                        "generated_number": v,
+                        "rarity": rarity,
+                        "rarity_percent": rarity_percent,
+                    }
+                },
+            )
+        )
+
+    if updates:
+        models.ComponentImage._get_collection().bulk_write(updates, ordered=False)
+
+    return rarities
+
+
+def get_art_image_rarity(component_ids, rarities):
+    rarity = 0
+    rarity_percent = 0
+    for component_id in component_ids:
+        component_rarity, component_rarity_percent = rarities.get(component_id, (0, 0))
+        rarity += component_rarity
+        rarity_percent += component_rarity_percent
+
+    return rarity, rarity_percent / max(len(component_ids), 1)
+
+
+def update_art_image_rarity(art_images, rarities, rarity_version):
+    if not art_images:
+        return
+
+    db = models.ArtImage._get_db()
+    bucket = models.ArtImage._fields["image"].collection_name
+
+    grid_ids = [data["image"] for data in art_images if data.get("image")]
+    filenames = {
+        data["_id"]: data["filename"]
+        for data in db[f"{bucket}.files"].find(
+            {"_id": {"$in": grid_ids}}, {"filename": 1}
+        )
+    }
+
+    updates = []
+    for data in art_images:
+        component_ids = [get_reference_id(c) for c in data.get("components", [])]
+        rarity, rarity_percent = get_art_image_rarity(component_ids, rarities)
+        filename = models.ArtImage.get_filename(
+            data.get("token_id"),
+            filenames.get(data.get("image"))
+            or data.get("render_spec", {}).get("filename"),
+        )
+
+        updates.append(
+            UpdateOne(
+                {"_id": data["_id"]},
+                {
+                    "$set": {
+                        "rarity": rarity,
+                        "rarity_percent": rarity_percent,
+                        "rarity_version": rarity_version,
+                        "name": f"{filename}",
+                        "description": f"#{filename}",
+                    }
+                },
+            )
+        )
+
+    if updates:
+        models.ArtImage._get_collection().bulk_write(updates, ordered=False)
+
+
+def refresh_art_image_rarity(collection, rarities, rarity_version, batch_size=1000):
+    # tokens already scored against this version are left alone
+    art_images = models.ArtImage.objects(
+        collection=collection, rarity_version__ne=rarity_version
+    )
+
+    count = 0
+    batch = []
+    fields = ["components", "image", "token_id", "render_spec"]
+    for data in art_images.only(*fields).as_pymongo():
+        batch.append(data)
+        if len(batch) >= batch_size:
+            update_art_image_rarity(batch, rarities, rarity_version)
+            count += len(batch)
+            batch = []
+
+    update_art_image_rarity(batch, rarities, rarity_version)
+    return count + len(batch)
+
+
+def count_trait(collection, batch_size=1000):
+    collection.reload()
+
+    statistic = {component_id: 0 for component_id in get_component_ids(collection)}
+    statistic.update(count_component_usage(collection))
+
+    total_image = models.ArtImage.objects(collection=collection).count()
+    rarities = update_component_rarity(statistic, total_image)
+
+    collection.generated_trait = sum(statistic.values())
+    collection.rarity_version += 1
+    collection.trait_counted = True
+    collection.save()
+
+    refresh_art_image_rarity(
+        collection, rarities, collection.rarity_version, batch_size=batch_size
+    )
+    print("trait counted", len(statistic), "components", total_image, "images")
+
+
+def record_component_usage(collection, statistic, sign=1):
+    updates = [
+        UpdateOne({"_id": component_id}, {"$inc": {"generated_number": sign * v}})
+        for component_id, v in statistic.items()
+        if v
+    ]
+    if not updates:
+        return
+
+    # counters nobody has rebuilt yet are left to the next full recount
+    counted = models.Collection.objects(
+        id=collection.id, trait_counted=True
+    ).update_one(
+        inc__generated_trait=sign * sum(statistic.values()), inc__rarity_version=1
+    )
+    if counted:
+        models.ComponentImage._get_collection().bulk_write(updates, ordered=False)
+
+
+def record_art_images(collection, art_images, sign=1):
+    statistic = collections.Counter(
+        component.id for art_image in art_images for component in art_image.components
+    )
+    record_component_usage(collection, statistic, sign)
+
+
+def refresh_rarity(collection):
+    """Rescore the tokens whose rarity_version is behind the collection's.
+
+    Rarity comes from the usage counters. A collection whose counters were
+    never rebuilt gets a full count_trait instead.
+    """
+    collection.reload("rarity_version", "trait_counted")
+    if not collection.trait_counted:
+        count_trait(collection)
+        return
+
+    rarity_version = collection.rarity_version
+    components = models.ComponentImage.objects(
+        id__in=get_component_ids(collection)
+    ).only("generated_number")
+    statistic = {c.id: max(c.generated_number, 0) for c in components}
+    rarities = update_component_rarity(statistic, collection.image_amount)
+
+    count = refresh_art_image_rarity(collection, rarities, rarity_version)
+    print("rarity refreshed", len(statistic), "components", count, "images")
+
+
+def enqueue_refresh_rarity(collection):
+    job_id = f"collection_rarity_{collection.id}"
+    job = redis_rq.redis_queue.get_job(job_id)
+    if job and job.get_status() == "queued":
+        return
+
+    try:
+        redis_rq.redis_queue.queue.enqueue(
+            refresh_rarity,
+            args=(collection,),
+            job_id=job_id,
+            timeout=600,
+            job_timeout=1200,
+        )
+    except Exception as e:
+        # the tokens stay behind rarity_version until the next refresh
+        print("cannot enqueue rarity refresh", e)
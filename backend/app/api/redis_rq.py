@@ -1,9 +1,19 @@
+import collections
+import json
+import threading
+import time
+
 import redis
 from rq import Worker, Queue, Connection
 from rq.job import Job
 
 listen = ["default"]
 
+CHANNEL_PREFIX = "collection_operation:"
+
+# queued progress updates per watcher, status changes are never dropped
+WATCHER_QUEUE_SIZE = 100
+
 
 class RedisQueue:
     def __init__(self, redis_url=""):
@@ -17,6 +27,18 @@ class RedisQueue:
         self.conn = redis.from_url(redis_url)
         self.queue = Queue(connection=self.conn)
 
+    def publish(self, collection_operation_id, data):
+        if not self.redis_url:
+            return
+
+        try:
+            self.conn.publish(
+                f"{CHANNEL_PREFIX}{collection_operation_id}",
+                json.dumps(data, default=str),
+            )
+        except Exception as e:
+            print("publish error", e)
+
     def get_job(self, job_key):
         job = None
         try:
@@ -26,7 +48,74 @@ class RedisQueue:
         return job
 
 
+class OperationBroadcaster:
+    """Fan one redis pattern subscription out to the asyncio queues of watchers."""
+
+    def __init__(self, redis_queue):
+        self.redis_queue = redis_queue
+        self.subscribers = collections.defaultdict(set)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.redis_queue.conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+                for message in pubsub.listen():
+                    self.dispatch(message)
+            except Exception as e:
+                print("broadcaster error", e)
+                time.sleep(1)
+
+    def dispatch(self, message):
+        channel = message["channel"].decode()
+        collection_operation_id = channel[len(CHANNEL_PREFIX) :]
+        data = message["data"].decode()
+        status = json.loads(data).get("event") == "status"
+
+        with self.lock:
+            watchers = list(self.subscribers.get(collection_operation_id, []))
+
+        for loop, queue in watchers:
+            loop.call_soon_threadsafe(offer, queue, data, status)
+
+    def subscribe(self, collection_operation_ids, loop, queue):
+        with self.lock:
+            for collection_operation_id in collection_operation_ids:
+                self.subscribers[collection_operation_id].add((loop, queue))
+
+        self.start()
+
+    def unsubscribe(self, collection_operation_ids, loop, queue):
+        with self.lock:
+            for collection_operation_id in collection_operation_ids:
+                watchers = self.subscribers.get(collection_operation_id)
+                if watchers is None:
+                    continue
+
+                watchers.discard((loop, queue))
+                if not watchers:
+                    self.subscribers.pop(collection_operation_id)
+
+
+def offer(queue, data, status=False):
+    # slow watchers drop progress instead of growing without bound, a status
+    # is always kept so the stream still sees the operation finish
+    if status or queue.qsize() < WATCHER_QUEUE_SIZE:
+        queue.put_nowait(data)
+
+
 redis_queue = RedisQueue()
+broadcaster = OperationBroadcaster(redis_queue)
 
 
 def init_rq(settings):
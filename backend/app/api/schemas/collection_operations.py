@@ -19,10 +19,81 @@ class CollectionOperationGeneratorSchema(BaseModel):
     amount: int = Field(..., example=10)
     generated_type: str = Field(..., example="normal-random")
     generated_class: str = Field(..., example="A")
+    workers: int = Field(
+        1, ge=1, le=64, description="Compositing processes for this run", example=1
+    )
+    compositor: str = Field("pillow", regex="^(pillow|numpy)$", example="pillow")
+    render_mode: str = Field(
+        "eager",
+        regex="^(eager|on-demand)$",
+        description="on-demand stores only the dna and renders on first read",
+        example="eager",
+    )
+    batch_size: int = Field(
+        100, ge=1, le=1000, description="Art images written per bulk insert"
+    )
+    layer_cache_size: int | None = Field(
+        None, description="Decoded layer cache budget in bytes", example=536870912
+    )
+    prefix_cache_size: int | None = Field(
+        None, description="Partial composite cache budget in bytes", example=268435456
+    )
+    seed: int | None = Field(
+        None, ge=0, description="Random seed, a new one is stored when empty"
+    )
+    preview_scale: float = Field(
+        0.25, gt=0, le=1, description="Layer scale used by preview runs"
+    )
+    shards: int = Field(
+        1,
+        ge=1,
+        le=64,
+        description="Split a quota-exact run into shard jobs over token ranges",
+        example=1,
+    )
+    checkpoint_interval: int = Field(
+        1000, ge=1, description="Slots generated between resumable checkpoints"
+    )
+
+
+class GenerationLayerEstimateSchema(BaseModel):
+    name: str | None
+    options: int
+    quota: int
+    padded: int
+    trimmed: int
+    satisfiable: bool
+
+
+class GenerationEstimateSchema(BaseModel):
+    requested: int
+    amount: int = Field(..., description="Images after capping to the possible space")
+    combinations: int = Field(..., description="Eligible layer option combinations")
+    existing: int
+    layers: list[GenerationLayerEstimateSchema]
+    plan: dict
+    simulated: int
+    extrapolated: bool = Field(
+        ..., description="Only the first slots were simulated, the rest is projected"
+    )
+    skipped: int = Field(..., description="Slots the generator would leave empty")
+    simulate_ms: float
+    tries: int
+    rejected: int
+    rejection_rate: float
+    sample: int
+    ms_per_image: float
+    bytes_per_image: float
+    estimated_render_seconds: float
+    estimated_bytes: int
+    render_mode: str
+    feasible: bool
 
 
 class CollectionOperationSchema(base.BaseSchema, BasedCollectionOperationSchema):
-    pass
+    message: dict | None = Field(
+        None, description="Progress, stage timings and run reports of the job"
+    )
 
 
 class CollectionOperationOutSchema(base.BaseSchema, BasedCollectionOperationSchema):
@@ -4,6 +4,14 @@ import datetime
 from app.api.schemas import base, users
 
 
+class CollectionEncoderSchema(BaseModel):
+    format: str = Field("png", regex="^(png|png-palette|webp)$", example="png")
+    compress_level: int = Field(6, ge=0, le=9, description="png zlib level")
+    optimize: bool = Field(False, description="png optimize pass")
+    method: int = Field(4, ge=0, le=6, description="lossless webp effort")
+    colors: int = Field(256, ge=2, le=256, description="png-palette colors")
+
+
 class BasedCollectionSchema(BaseModel):
     name: str = Field(..., example="The grestest art work")
     description: str | None = Field(
@@ -14,6 +22,8 @@ class BasedCollectionSchema(BaseModel):
     )
     metadata_format: str = Field("opensea", example="opensea")
     file_host: str | None = Field("pinata", example="pinata")
+    encoder: CollectionEncoderSchema | None = None
+
 
 class CollectionCreatedSchema(BasedCollectionSchema):
     file_api_key: str | None = Field(None, example="")
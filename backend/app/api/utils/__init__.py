@@ -1 +1,4 @@
 from . import metadata_generators
+from . import renderers
+from . import render_cache
+from . import samplers
@@ -0,0 +1,105 @@
+import email.utils
+import hashlib
+import os
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+CHUNK_SIZE = 256 * 1024
+
+
+def get_etag(stat):
+    etag = hashlib.md5(f"{stat.st_mtime}-{stat.st_size}".encode()).hexdigest()
+    return f'"{etag}"'
+
+
+def parse_range(range_header, size):
+    # a single bytes range, anything else is answered with the whole file
+    unit, _, value = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in value:
+        return None
+
+    start, _, end = value.strip().partition("-")
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                raise HTTPException(
+                    status_code=416, headers={"Content-Range": f"bytes */{size}"}
+                )
+            return max(size - length, 0), size - 1
+
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+
+    if start >= size:
+        raise HTTPException(
+            status_code=416, headers={"Content-Range": f"bytes */{size}"}
+        )
+
+    if start > end:
+        return None
+
+    return start, min(end, size - 1)
+
+
+def iter_file(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def file_response(path, request, media_type, filename=None):
+    """Stream a file from disk with ETag and single Range support.
+
+    The file is opened before the headers are built, so an archive that is
+    replaced while the download runs keeps serving the version it started with.
+    """
+    f = open(path, "rb")
+    try:
+        stat = os.fstat(f.fileno())
+        etag = get_etag(stat)
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+            "Last-Modified": last_modified,
+        }
+        if filename:
+            headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+        byte_range = None
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        # a stale If-Range validator means the client must start over
+        if range_header and (not if_range or if_range in [etag, last_modified]):
+            byte_range = parse_range(range_header, stat.st_size)
+    except BaseException:
+        f.close()
+        raise
+
+    status_code = 200
+    start, end = 0, stat.st_size - 1
+    if byte_range:
+        status_code = 206
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file(f, start, end - start + 1),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
@@ -21,12 +21,12 @@ class OpenseaMetadataGenerator(SimpleMetadataGenerator):
         data["name"] = art_image.name
         data["description"] = art_image.description
         data["image"] = data["image"].format(
-            token_cid=collection.file_token_cid, filename=art_image.image.filename
+            token_cid=collection.file_token_cid, filename=art_image.filename
         )
         data["external_url"] = collection.external_url_template.format(
             id=str(art_image.id),
-            filename=art_image.image.filename,
-            filename_without_extension=art_image.image.filename.split(".")[0],
+            filename=art_image.filename,
+            filename_without_extension=art_image.filename.split(".")[0],
         )
 
         data["attributes"] = []
@@ -0,0 +1,95 @@
+import os
+import pathlib
+import threading
+
+from app import config
+
+
+class RenderCache:
+    def __init__(self, path, max_size):
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def get_path(self, key):
+        return self.path / key[:2] / key
+
+    def get_files(self):
+        if not self.path.exists():
+            return []
+
+        return [
+            p
+            for p in self.path.glob("*/*")
+            if p.is_file() and not p.name.endswith(".tmp")
+        ]
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # touch so eviction drops the least recently read renders first
+        os.utime(path)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_size:
+            return
+
+        path = self.get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write aside and rename so concurrent readers never see partial files
+        temporary = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary, "wb") as f:
+            f.write(data)
+        temporary.replace(path)
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(p.stat().st_size for p in self.get_files())
+            else:
+                self.size += len(data)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        files = []
+        for p in self.get_files():
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, p))
+
+        files.sort()
+        self.size = sum(f[1] for f in files)
+
+        # shrink to 90% so a full cache does not rescan on every put
+        limit = self.max_size * 0.9
+        for mtime, size, p in files:
+            if self.size <= limit:
+                break
+
+            p.unlink(missing_ok=True)
+            self.size -= size
+
+
+render_cache = None
+
+
+def get_render_cache():
+    global render_cache
+    if render_cache is None:
+        render_cache = RenderCache(
+            f"{config.settings.HERMES_DATA_DIR}/renders",
+            config.settings.RENDER_CACHE_SIZE,
+        )
+
+    return render_cache
@@ -0,0 +1,484 @@
+import collections
+import io
+import math
+import os
+import time
+
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def get_image_size(img):
+    return img.width * img.height * len(img.getbands())
+
+
+def get_layer_size(layer):
+    return layer.size
+
+
+def get_alpha_bbox(img):
+    return img.getchannel("A").getbbox()
+
+
+def has_alpha(img):
+    return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+
+def open_image(data):
+    img = Image.open(io.BytesIO(data))
+    return img.convert("RGBA"), has_alpha(img)
+
+
+def decode_image(data):
+    return open_image(data)[0]
+
+
+class PillowLayer:
+    def __init__(self, img, offset=(0, 0), alpha=True):
+        self.img = img
+        self.offset = offset
+        self.alpha = alpha
+        self.size = get_image_size(img) if img is not None else 0
+
+
+class ArrayLayer:
+    """RGBA layer held as arrays ready for Pillow's paste-with-mask blend.
+
+    ``premultiplied`` is ``src * alpha`` and ``inverse_alpha`` is
+    ``255 - alpha``; both are uint16 so a blend never overflows.
+    """
+
+    def __init__(self, img, offset=(0, 0), alpha=True):
+        self.offset = offset
+        self.alpha = alpha
+        self.src = None
+        self.size = 0
+        if img is None:
+            return
+
+        src = np.asarray(img, dtype=np.uint16)
+        alpha = src[:, :, 3:4]
+
+        self.src = np.asarray(img, dtype=np.uint8)
+        self.premultiplied = src * alpha
+        self.inverse_alpha = 255 - alpha
+        self.size = (
+            self.src.nbytes + self.premultiplied.nbytes + self.inverse_alpha.nbytes
+        )
+
+    @property
+    def shape(self):
+        return self.src.shape[:2]
+
+
+def decode_pillow_layer(data, offset):
+    if data is None:
+        return PillowLayer(None, offset)
+
+    img, alpha = open_image(data)
+    return PillowLayer(img, offset, alpha)
+
+
+def decode_array_layer(data, offset):
+    if data is None:
+        return ArrayLayer(None, offset)
+
+    img, alpha = open_image(data)
+    return ArrayLayer(img, offset, alpha)
+
+
+def blend_array_layer(dst, layer):
+    if layer.src is None:
+        return
+
+    x, y = layer.offset
+    h = min(dst.shape[-3] - y, layer.shape[0])
+    w = min(dst.shape[-2] - x, layer.shape[1])
+    if h <= 0 or w <= 0:
+        return
+
+    region = dst[..., y : y + h, x : x + w, :]
+    value = region * layer.inverse_alpha[:h, :w] + layer.premultiplied[:h, :w]
+    value += 128
+    dst[..., y : y + h, x : x + w, :] = ((value >> 8) + value) >> 8
+
+
+class LayerCache:
+    def __init__(
+        self, loader, max_size, decode=decode_pillow_layer, sizeof=get_layer_size
+    ):
+        self.loader = loader
+        self.max_size = max_size
+        self.decode = decode
+        self.sizeof = sizeof
+
+        self.images = collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fetch_time = 0
+        self.decode_time = 0
+
+    def get(self, key, cropped=False):
+        cache_key = (key, cropped)
+        layer = self.images.get(cache_key)
+        if layer is not None:
+            self.images.move_to_end(cache_key)
+            self.hits += 1
+            return layer
+
+        self.misses += 1
+        started = time.perf_counter()
+        data = self.loader(key, cropped)
+        fetched = time.perf_counter()
+        layer = self.decode(*data)
+        self.fetch_time += fetched - started
+        self.decode_time += time.perf_counter() - fetched
+        self.put(cache_key, layer)
+        return layer
+
+    def put(self, key, img):
+        img_size = self.sizeof(img)
+        if img_size > self.max_size:
+            return
+
+        if key in self.images:
+            self.size -= self.sizeof(self.images.pop(key))
+
+        self.images[key] = img
+        self.size += img_size
+
+        while self.size > self.max_size:
+            _, old_img = self.images.popitem(last=False)
+            self.size -= self.sizeof(old_img)
+            self.evictions += 1
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            items=len(self.images),
+            size=self.size,
+            max_size=self.max_size,
+            fetch_ms=self.fetch_time * 1000,
+            decode_ms=self.decode_time * 1000,
+        )
+
+
+class PrefixCache(LayerCache):
+    def __init__(self, max_size, sizeof=get_image_size):
+        super().__init__(None, max_size, decode=None, sizeof=sizeof)
+        self.pinned = {}
+
+    def pin(self, prefix, img):
+        self.pinned[prefix] = img
+
+    def lookup(self, keys):
+        for k in range(len(keys) - 1, 1, -1):
+            prefix = tuple(keys[:k])
+            img = self.images.get(prefix)
+            if img is not None:
+                self.images.move_to_end(prefix)
+                self.hits += 1
+                return k, img
+
+            img = self.pinned.get(prefix)
+            if img is not None:
+                self.hits += 1
+                return k, img
+
+        self.misses += 1
+        return 0, None
+
+
+def get_contact_sheet(imgs, columns=10):
+    if not imgs:
+        return Image.new("RGBA", (1, 1))
+
+    width = max(img.width for img in imgs)
+    height = max(img.height for img in imgs)
+    columns = min(columns, len(imgs))
+    rows = math.ceil(len(imgs) / columns)
+
+    sheet = Image.new("RGBA", (columns * width, rows * height))
+    for i, img in enumerate(imgs):
+        sheet.paste(img, ((i % columns) * width, (i // columns) * height))
+
+    return sheet
+
+
+ENCODER_FORMATS = {
+    "png": ("PNG", "image/png", "png"),
+    "png-palette": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+}
+
+
+class ImageEncoder:
+    def __init__(self, options=None):
+        self.options = options or {}
+        self.format = self.options.get("format", "png")
+        if self.format not in ENCODER_FORMATS:
+            raise Exception(f"encoder format {self.format} not found")
+
+        self.image_format, self.content_type, self.extension = ENCODER_FORMATS[
+            self.format
+        ]
+
+        self.count = 0
+        self.size = 0
+        self.time = 0
+
+    def get_save_options(self):
+        if self.format == "webp":
+            return dict(lossless=True, method=self.options.get("method", 4))
+
+        return dict(
+            compress_level=self.options.get("compress_level", 6),
+            optimize=self.options.get("optimize", False),
+        )
+
+    def encode(self, img):
+        started = time.perf_counter()
+
+        if self.format == "png-palette":
+            quantize = getattr(Image, "Quantize", Image)
+            img = img.quantize(
+                colors=self.options.get("colors", 256), method=quantize.FASTOCTREE
+            )
+
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format=self.image_format, **self.get_save_options())
+        data = img_bytes.getvalue()
+
+        self.time += time.perf_counter() - started
+        self.count += 1
+        self.size += len(data)
+        return data
+
+    def stats(self):
+        return dict(
+            encode_count=self.count,
+            encode_size=self.size,
+            encode_ms=self.time * 1000,
+        )
+
+
+def get_render_order(keys_list):
+    return sorted(range(len(keys_list)), key=lambda i: list(keys_list[i]))
+
+
+def get_shared_lengths(keys_list, order):
+    shared = [0] * len(keys_list)
+    for current, following in zip(order, order[1:]):
+        length = 0
+        for key, following_key in zip(keys_list[current], keys_list[following]):
+            if key != following_key:
+                break
+            length += 1
+
+        shared[current] = length
+
+    return shared
+
+
+def get_output_image(img, base):
+    # layers composite in RGBA, an opaque base keeps the output RGB
+    if base.alpha:
+        return img
+
+    return img.convert("RGB")
+
+
+class ImageRenderer:
+    def __init__(self, loader, cache_size, prefix_cache_size=0, encoder=None):
+        self.layers = LayerCache(loader, cache_size)
+        self.prefixes = PrefixCache(prefix_cache_size)
+        self.encoder = ImageEncoder(encoder)
+        self.composite_time = 0
+
+    def composite(self, keys, shared=0):
+        base = self.layers.get(keys[0])
+        start, img = self.prefixes.lookup(keys)
+        if img is None:
+            start, img = 1, base.img
+
+        img = img.copy()
+        for k in range(start, len(keys)):
+            layer = self.layers.get(keys[k], cropped=True)
+            if layer.img is not None:
+                img.paste(layer.img, layer.offset, layer.img)
+
+            if k + 1 <= shared:
+                self.prefixes.put(tuple(keys[: k + 1]), img.copy())
+
+        return get_output_image(img, base)
+
+    def composite_many(self, keys_list):
+        order = get_render_order(keys_list)
+        shared = get_shared_lengths(keys_list, order)
+
+        results = [None] * len(keys_list)
+        for i in order:
+            results[i] = self.composite(keys_list[i], shared[i])
+
+        return results
+
+    def set_base(self, keys):
+        if len(keys) > 1:
+            self.prefixes.pin(tuple(keys), self.composite(keys).convert("RGBA"))
+
+    def encode(self, img):
+        return self.encoder.encode(img)
+
+    def render(self, keys):
+        return self.encode(self.composite(keys))
+
+    def get_layer_time(self):
+        return self.layers.fetch_time + self.layers.decode_time
+
+    def render_many(self, tasks):
+        started = time.perf_counter()
+        layer_time = self.get_layer_time()
+        imgs = self.composite_many([keys for _, keys in tasks])
+
+        # layer fetch and decode happen inside compositing, report them apart
+        elapsed = time.perf_counter() - started
+        self.composite_time += elapsed - (self.get_layer_time() - layer_time)
+
+        return [(image_id, self.encode(img)) for (image_id, _), img in zip(tasks, imgs)]
+
+    def stats(self):
+        data = self.layers.stats()
+        for k, v in self.prefixes.stats().items():
+            data[f"prefix_{k}"] = v
+
+        data["composite_ms"] = self.composite_time * 1000
+        data.update(self.encoder.stats())
+        return data
+
+
+class ArrayImageRenderer(ImageRenderer):
+    def __init__(self, loader, cache_size, prefix_cache_size=0, encoder=None):
+        if np is None:
+            raise Exception("numpy is required for the numpy compositor")
+
+        self.encoder = ImageEncoder(encoder)
+        self.composite_time = 0
+        self.layers = LayerCache(loader, cache_size, decode=decode_array_layer)
+        self.prefixes = PrefixCache(prefix_cache_size, sizeof=lambda a: a.nbytes)
+
+    def composite(self, keys, shared=0):
+        return self.composite_many([keys])[0]
+
+    def set_base(self, keys):
+        if len(keys) > 1:
+            base = self.composite(keys).convert("RGBA")
+            self.prefixes.pin(tuple(keys), np.asarray(base))
+
+    def composite_many(self, keys_list):
+        order = get_render_order(keys_list)
+        shared = get_shared_lengths(keys_list, order)
+
+        canvases = collections.defaultdict(list)
+        for i in order:
+            canvases[self.layers.get(keys_list[i][0]).shape].append(i)
+
+        results = [None] * len(keys_list)
+        for indexes in canvases.values():
+            starts = []
+            arrays = []
+            for i in indexes:
+                start, array = self.prefixes.lookup(keys_list[i])
+                if array is None:
+                    start, array = 1, self.layers.get(keys_list[i][0]).src
+                starts.append(start)
+                arrays.append(array)
+
+            batch = np.stack(arrays).astype(np.uint16)
+
+            depth = max(len(keys_list[i]) for i in indexes)
+            for k in range(1, depth):
+                # rows sharing a prefix up to this layer hold identical pixels,
+                # so only one row per prefix is blended and then copied over
+                prefixes = collections.defaultdict(list)
+                for row, i in enumerate(indexes):
+                    if starts[row] <= k < len(keys_list[i]):
+                        prefixes[tuple(keys_list[i][: k + 1])].append(row)
+
+                rows = collections.defaultdict(list)
+                for prefix, prefix_rows in prefixes.items():
+                    rows[prefix[-1]].append(prefix_rows[0])
+
+                for key, layer_rows in rows.items():
+                    layer = self.layers.get(key, cropped=True)
+                    if len(layer_rows) == len(indexes):
+                        blend_array_layer(batch, layer)
+                        continue
+
+                    layer_rows = np.array(layer_rows)
+                    region = batch[layer_rows]
+                    blend_array_layer(region, layer)
+                    batch[layer_rows] = region
+
+                for prefix, prefix_rows in prefixes.items():
+                    if len(prefix_rows) > 1:
+                        batch[prefix_rows[1:]] = batch[prefix_rows[0]]
+
+                    if any(k + 1 <= shared[indexes[row]] for row in prefix_rows):
+                        self.prefixes.put(
+                            prefix, batch[prefix_rows[0]].astype(np.uint8)
+                        )
+
+            for row, i in enumerate(indexes):
+                results[i] = get_output_image(
+                    Image.fromarray(batch[row].astype(np.uint8)),
+                    self.layers.get(keys_list[i][0]),
+                )
+
+        return results
+
+
+COMPOSITORS = dict(pillow=ImageRenderer, numpy=ArrayImageRenderer)
+
+
+def get_renderer(compositor, loader, cache_size, prefix_cache_size=0, encoder=None):
+    renderer_class = COMPOSITORS.get(compositor)
+    if not renderer_class:
+        raise Exception(f"compositor {compositor} not found")
+
+    return renderer_class(loader, cache_size, prefix_cache_size, encoder)
+
+
+worker_renderer = None
+
+
+def init_worker(
+    layer_images,
+    cache_size,
+    compositor="pillow",
+    prefix_cache_size=0,
+    base_keys=None,
+    encoder=None,
+):
+    global worker_renderer
+
+    def loader(key, cropped=False):
+        return layer_images[(key, cropped)]
+
+    worker_renderer = get_renderer(
+        compositor, loader, cache_size, prefix_cache_size, encoder
+    )
+    worker_renderer.set_base(base_keys or [])
+
+
+def render_worker(tasks):
+    results = worker_renderer.render_many(tasks)
+    return os.getpid(), results, worker_renderer.stats()
@@ -0,0 +1,174 @@
+import math
+import random
+
+
+class ProductSampler:
+    """Draw indices of itertools.product(*layers) uniformly without replacement.
+
+    The permutation is a sparse Fisher-Yates shuffle of range(total), so only
+    the positions already drawn are kept in memory.
+    """
+
+    def __init__(self, sizes, rng=random):
+        self.sizes = list(sizes)
+        self.total = math.prod(self.sizes) if self.sizes else 0
+        self.random = rng
+
+        self.position = 0
+        self.swaps = {}
+
+    def __len__(self):
+        return self.total - self.position
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= self.total:
+            raise StopIteration
+
+        i = self.position
+        j = self.random.randrange(i, self.total)
+
+        index = self.swaps.get(j, j)
+        if j == i:
+            self.swaps.pop(i, None)
+        else:
+            self.swaps[j] = self.swaps.pop(i, i)
+
+        self.position += 1
+        return self.decode(index)
+
+    def getstate(self):
+        # indices can exceed int64, keep them as strings for mongo
+        return dict(
+            position=str(self.position),
+            swaps=[[str(k), str(v)] for k, v in self.swaps.items()],
+        )
+
+    def setstate(self, state):
+        self.position = int(state["position"])
+        self.swaps = {int(k): int(v) for k, v in state["swaps"]}
+
+    def decode(self, index):
+        digits = []
+        for size in reversed(self.sizes):
+            index, digit = divmod(index, size)
+            digits.append(digit)
+
+        return tuple(reversed(digits))
+
+
+class QuotaPlanner:
+    """Assign one option per layer to every slot so each quota is met exactly.
+
+    ``columns`` holds, for every layer, the remaining quota of each option and
+    ``blanks`` the index of the option used to pad a layer whose quotas do not
+    add up to ``amount`` (None pads by quota share). Duplicate rows are
+    repaired by swapping cells inside one column, which keeps the per-option
+    totals intact.
+    """
+
+    def __init__(self, columns, blanks, amount, exists=None, rng=random):
+        self.columns = columns
+        self.blanks = blanks
+        self.amount = amount
+        self.exists = exists or (lambda row: False)
+        self.random = rng
+
+        self.MAX_REPAIR = 100
+        self.report = dict(amount=amount, padded=[], trimmed=[], repaired=0)
+
+    def expand(self, quotas, blank):
+        column = []
+        for index, quota in enumerate(quotas):
+            column.extend([index] * max(quota, 0))
+
+        self.random.shuffle(column)
+
+        trimmed = max(len(column) - self.amount, 0)
+        if trimmed and blank is not None:
+            kept = [i for i in column if i != blank]
+            blanks = [blank] * (self.amount - len(kept))
+            column = kept[: self.amount] + blanks
+        column = column[: self.amount]
+
+        padded = self.amount - len(column)
+        if padded:
+            if blank is not None:
+                column.extend([blank] * padded)
+            else:
+                shares = sorted(
+                    range(len(quotas)), key=lambda i: quotas[i], reverse=True
+                )
+                column.extend(shares[i % len(shares)] for i in range(padded))
+
+        self.random.shuffle(column)
+        self.report["padded"].append(padded)
+        self.report["trimmed"].append(trimmed)
+        return column
+
+    def plan(self):
+        columns = [
+            self.expand(quotas, blank)
+            for quotas, blank in zip(self.columns, self.blanks)
+        ]
+        rows = [list(row) for row in zip(*columns)]
+
+        seen = set()
+        conflicts = []
+        for index, row in enumerate(rows):
+            key = tuple(row)
+            if key in seen or self.exists(key):
+                conflicts.append(index)
+                continue
+            seen.add(key)
+
+        pending = set(conflicts)
+        unresolved = set()
+        for index in conflicts:
+            key = tuple(rows[index])
+            # an earlier repair may have moved the row this one collided with
+            if key not in seen and not self.exists(key):
+                seen.add(key)
+                pending.discard(index)
+            elif self.repair(rows, index, seen, pending):
+                pending.discard(index)
+            else:
+                unresolved.add(index)
+
+        self.report["unresolved"] = len(unresolved)
+        return [tuple(row) for i, row in enumerate(rows) if i not in unresolved]
+
+    def repair(self, rows, index, seen, pending):
+        row = rows[index]
+        for _ in range(self.MAX_REPAIR):
+            layer = self.random.randrange(len(row))
+            other = self.random.randrange(len(rows))
+            if other == index or other in pending:
+                continue
+
+            other_row = rows[other]
+            if other_row[layer] == row[layer] or tuple(other_row) not in seen:
+                continue
+
+            new_row = list(row)
+            new_other_row = list(other_row)
+            new_row[layer], new_other_row[layer] = other_row[layer], row[layer]
+
+            new_key = tuple(new_row)
+            new_other_key = tuple(new_other_row)
+            if new_key in seen or new_other_key in seen or new_key == new_other_key:
+                continue
+            if self.exists(new_key) or self.exists(new_other_key):
+                continue
+
+            seen.remove(tuple(other_row))
+            seen.add(new_key)
+            seen.add(new_other_key)
+            rows[index] = new_row
+            rows[other] = new_other_row
+            self.report["repaired"] += 1
+            return True
+
+        return False
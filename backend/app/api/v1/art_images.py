@@ -3,6 +3,7 @@ from fastapi.responses import Response
 import io
 
 from app import models
+from app.api.jobs import trait_statistics
 from .. import schemas
 from .. import core
 
@@ -49,10 +50,15 @@ def delete_art_images(
     db_art_images = models.ArtImage.objects(collection=db_collection)
     data = list(db_art_images).copy()
 
+    statistic = trait_statistics.count_component_usage(db_collection)
+    trait_statistics.record_component_usage(db_collection, statistic, -1)
+
     for ai in db_art_images:
         ai.image.delete()
         ai.delete()
 
+    trait_statistics.enqueue_refresh_rarity(db_collection)
+
     return
 
 
@@ -115,8 +121,11 @@ def delete(
         )
 
     data = schemas.art_images.ArtImageSchema.from_orm(db_art_image)
+    db_collection = db_art_image.collection
+    trait_statistics.record_art_images(db_collection, [db_art_image], -1)
     db_art_image.image.delete()
     db_art_image.delete()
+    trait_statistics.enqueue_refresh_rarity(db_collection)
 
     return data
 
@@ -132,6 +141,6 @@ def download(art_image_id: str, filename: str):
             detail=f"There are no {art_image_id} art_image in system",
         )
 
-    img = art_image.image.read()
-    content_type = art_image.image.content_type
+    img = art_image.read_image()
+    content_type = art_image.content_type
     return Response(content=img, media_type=content_type)
@@ -1,11 +1,22 @@
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
+import asyncio
 import datetime
+import io
+import json
+from typing import Union
+
+from PIL import Image
 
 
 from app import models, config
 from app.api import redis_rq
+from app.api.utils import renderers
 from app.api.jobs import art_generator
+from app.api.jobs import generation_estimator
+from app.api.jobs import art_previews
 from app.api.jobs import collection_uploader
 from app.api.jobs import file_operator
 from .. import schemas
@@ -14,14 +25,62 @@ from .. import core
 router = APIRouter(prefix="/collection-operations", tags=["collection-operations"])
 
 
+def get_generate_operation(
+    db_collection, collection_operation, current_user, command_type="generate"
+):
+    now = datetime.datetime.utcnow()
+    db_collection_operation = models.CollectionOperation(
+        command_type=command_type,
+        owner=current_user,
+        collection=db_collection,
+        amount=collection_operation.amount,
+        submitted_date=now,
+        parameters=dict(
+            generated_type=collection_operation.generated_type,
+            generated_class=collection_operation.generated_class,
+            workers=collection_operation.workers,
+            batch_size=collection_operation.batch_size,
+            compositor=collection_operation.compositor,
+            render_mode=collection_operation.render_mode,
+            checkpoint_interval=collection_operation.checkpoint_interval,
+            shards=collection_operation.shards,
+        ),
+    )
+    if (
+        collection_operation.shards > 1
+        and collection_operation.generated_type not in art_generator.SHARDED_GENERATORS
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Generated type {collection_operation.generated_type} cannot be sharded, use {', '.join(art_generator.SHARDED_GENERATORS)}",
+        )
+
+    if collection_operation.seed is not None:
+        db_collection_operation.parameters["seed"] = collection_operation.seed
+    if collection_operation.layer_cache_size:
+        db_collection_operation.parameters[
+            "layer_cache_size"
+        ] = collection_operation.layer_cache_size
+    if collection_operation.prefix_cache_size:
+        db_collection_operation.parameters[
+            "prefix_cache_size"
+        ] = collection_operation.prefix_cache_size
+
+    return db_collection_operation
+
+
 @router.post(
     "/{collection_id}/generate",
     response_model_by_alias=False,
-    response_model=schemas.collection_operations.CollectionOperationSchema,
+    response_model=Union[
+        schemas.collection_operations.CollectionOperationSchema,
+        schemas.collection_operations.GenerationEstimateSchema,
+    ],
 )
 def generate(
     collection_id: str,
     collection_operation: schemas.collection_operations.CollectionOperationGeneratorSchema,
+    dry_run: bool = False,
     current_user: models.User = Depends(core.deps.get_current_user),
 ):
     db_collection = models.Collection.objects(
@@ -33,17 +92,20 @@ def generate(
             detail=f"There are no {collection_operation.collection_id} collection in system",
         )
 
-    now = datetime.datetime.utcnow()
-    db_collection_operation = models.CollectionOperation(
-        owner=current_user,
-        collection=db_collection,
-        amount=collection_operation.amount,
-        submitted_date=now,
-        parameters=dict(
-            generated_type=collection_operation.generated_type,
-            generated_class=collection_operation.generated_class,
-        ),
+    db_collection_operation = get_generate_operation(
+        db_collection, collection_operation, current_user
     )
+
+    if dry_run:
+        # nothing is saved, the estimate runs on the unsaved operation
+        try:
+            return generation_estimator.estimate(db_collection_operation)
+        except Exception as e:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Connot estimate generation, {e}",
+            )
+
     db_collection_operation.save()
 
     kwargs = {}
@@ -73,6 +135,99 @@ def generate(
     return db_collection_operation
 
 
+@router.post(
+    "/{collection_id}/preview",
+    response_model_by_alias=False,
+    response_model=schemas.collection_operations.CollectionOperationSchema,
+)
+def preview(
+    collection_id: str,
+    collection_operation: schemas.collection_operations.CollectionOperationGeneratorSchema,
+    current_user: models.User = Depends(core.deps.get_current_user),
+):
+    db_collection = models.Collection.objects(
+        id=collection_id, owner=current_user
+    ).first()
+    if not db_collection:
+        raise HTTPException(
+            status_code=404,
+            detail=f"There are no {collection_id} collection in system",
+        )
+
+    db_collection_operation = get_generate_operation(
+        db_collection, collection_operation, current_user, command_type="preview"
+    )
+    db_collection_operation.parameters[
+        "preview_scale"
+    ] = collection_operation.preview_scale
+    db_collection_operation.save()
+
+    kwargs = {}
+
+    try:
+        job = redis_rq.redis_queue.queue.enqueue(
+            art_previews.generate_preview,
+            args=(db_collection_operation,),
+            kwargs=kwargs,
+            job_id=f"collection_operation_{db_collection_operation.id}",
+            timeout=600,
+            job_timeout=3600,
+        )
+    except Exception as e:
+        db_collection_operation.status = "error"
+        db_collection_operation.updated_date = datetime.datetime.now()
+        db_collection_operation.save()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Connot complete job, {e}",
+        )
+
+    db_collection_operation.status = job.get_status()
+    db_collection_operation.updated_date = datetime.datetime.now()
+    db_collection_operation.save()
+
+    return db_collection_operation
+
+
+@router.get(
+    "/{collection_operation_id}/contact-sheet",
+)
+def get_contact_sheet(
+    collection_operation_id: str,
+    start: int = 0,
+    limit: int = 100,
+    columns: int = 10,
+    current_user: models.User = Depends(core.deps.get_current_user),
+):
+    db_collection_operation = models.CollectionOperation.objects(
+        id=collection_operation_id, owner=current_user
+    ).first()
+    if not db_collection_operation:
+        raise HTTPException(
+            status_code=404,
+            detail=f"There are no collection_operation {collection_operation_id} in system",
+        )
+
+    db_preview_images = (
+        models.PreviewImage.objects(command=db_collection_operation)
+        .order_by("token_id")
+        .skip(start)
+        .limit(limit)
+        .only("data")
+    )
+    imgs = [Image.open(io.BytesIO(pi.data)) for pi in db_preview_images]
+    if not imgs:
+        raise HTTPException(
+            status_code=404,
+            detail=f"There are no previews for {collection_operation_id}, they may have expired",
+        )
+
+    sheet = renderers.get_contact_sheet(imgs, max(columns, 1))
+    img_bytes = io.BytesIO()
+    sheet.save(img_bytes, format="PNG", compress_level=1)
+    return Response(content=img_bytes.getvalue(), media_type="image/png")
+
+
 @router.post(
     "/{collection_id}/count-trait",
     response_model_by_alias=False,
@@ -181,6 +336,60 @@ def shake_token_id(
     return db_collection_operation
 
 
+@router.post(
+    "/{collection_id}/backfill-bbox",
+    response_model_by_alias=False,
+    response_model=schemas.collection_operations.CollectionOperationSchema,
+)
+def backfill_bbox(
+    collection_id: str,
+    current_user: models.User = Depends(core.deps.get_current_user),
+):
+    db_collection = models.Collection.objects(
+        id=collection_id, owner=current_user
+    ).first()
+    if not db_collection:
+        raise HTTPException(
+            status_code=404,
+            detail=f"There are no {collection_id} collection in system",
+        )
+
+    now = datetime.datetime.utcnow()
+    db_collection_operation = models.CollectionOperation(
+        command_type="backfill-bbox",
+        owner=current_user,
+        collection=db_collection,
+        submitted_date=now,
+    )
+    db_collection_operation.save()
+
+    kwargs = {}
+
+    try:
+        job = redis_rq.redis_queue.queue.enqueue(
+            art_generator.backfill_bbox,
+            args=(db_collection_operation,),
+            kwargs=kwargs,
+            job_id=f"collection_operation_{db_collection_operation.id}",
+            timeout=600,
+            job_timeout=1200,
+        )
+    except Exception as e:
+        db_collection_operation.status = "error"
+        db_collection_operation.updated_date = datetime.datetime.now()
+        db_collection_operation.save()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Connot complete job, {e}",
+        )
+
+    db_collection_operation.status = job.get_status()
+    db_collection_operation.updated_date = datetime.datetime.now()
+    db_collection_operation.save()
+
+    return db_collection_operation
+
+
 @router.post(
     "/{collection_id}/upload",
     response_model_by_alias=False,
@@ -289,6 +498,178 @@ def create_archive(
     return db_collection_operation
 
 
+RESUMABLE_JOB_STATUSES = ["failed", "stopped", "canceled"]
+
+
+@router.post(
+    "/{collection_operation_id}/resume",
+    response_model_by_alias=False,
+    response_model=schemas.collection_operations.CollectionOperationSchema,
+)
+def resume(
+    collection_operation_id: str,
+    current_user: models.User = Depends(core.deps.get_current_user),
+):
+    db_collection_operation = models.CollectionOperation.objects(
+        id=collection_operation_id, owner=current_user
+    ).first()
+    if not db_collection_operation:
+        raise HTTPException(
+            status_code=404,
+            detail=f"There are no collection_operation {collection_operation_id} in system",
+        )
+
+    if db_collection_operation.command_type not in ["generate", "generate-shard"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Collection operation {collection_operation_id} is not a generation",
+        )
+
+    if db_collection_operation.status == "completed":
+        raise HTTPException(
+            status_code=409,
+            detail=f"Collection operation {collection_operation_id} is already completed",
+        )
+
+    if (
+        db_collection_operation.command_type == "generate"
+        and db_collection_operation.parameters.get("shards", 1) > 1
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Collection operation {collection_operation_id} is sharded, resume its failed shards instead",
+        )
+
+    if not db_collection_operation.checkpoint:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Collection operation {collection_operation_id} has no checkpoint",
+        )
+
+    # a queued or running job would share the checkpoint with the resume, so
+    # only take over from jobs that ended without completing
+    for job_id in [
+        f"collection_operation_{db_collection_operation.id}",
+        f"collection_operation_{db_collection_operation.id}_resume",
+    ]:
+        job = redis_rq.redis_queue.get_job(job_id)
+        if job and job.get_status() not in RESUMABLE_JOB_STATUSES:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Collection operation {collection_operation_id} job is {job.get_status()}",
+            )
+
+    kwargs = {}
+
+    try:
+        job = redis_rq.redis_queue.queue.enqueue(
+            art_generator.resume,
+            args=(db_collection_operation,),
+            kwargs=kwargs,
+            job_id=f"collection_operation_{db_collection_operation.id}_resume",
+            timeout=600,
+            job_timeout=21600,
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Connot complete job, {e}",
+        )
+
+    db_collection_operation.status = job.get_status()
+    db_collection_operation.updated_date = datetime.datetime.now()
+    db_collection_operation.save()
+
+    return db_collection_operation
+
+
+FINISHED_STATUSES = ["completed", "error", "failed"]
+
+
+def get_event(data):
+    return f"data: {json.dumps(data, default=str)}\n\n"
+
+
+def get_owned_operation_ids(ids, current_user):
+    db_collection_operations = models.CollectionOperation.objects(
+        id__in=[i for i in ids.split(",") if i], owner=current_user
+    ).only("id")
+    return [str(co.id) for co in db_collection_operations]
+
+
+def get_status_snapshots(collection_operation_ids):
+    db_collection_operations = models.CollectionOperation.objects(
+        id__in=collection_operation_ids
+    ).only("id", "status", "message")
+    return [
+        dict(
+            id=str(co.id),
+            event="status",
+            status=co.status,
+            progress=co.message.get("progress"),
+        )
+        for co in db_collection_operations
+    ]
+
+
+@router.get(
+    "/events",
+)
+async def stream_events(
+    ids: str,
+    current_user: models.User = Depends(core.deps.get_current_user),
+):
+    collection_operation_ids = await run_in_threadpool(
+        get_owned_operation_ids, ids, current_user
+    )
+    if not collection_operation_ids:
+        raise HTTPException(
+            status_code=404,
+            detail=f"There are no collection_operation {ids} in system",
+        )
+
+    # subscribe before reading the snapshot so no status change falls between
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    redis_rq.broadcaster.subscribe(collection_operation_ids, loop, queue)
+
+    try:
+        snapshots = await run_in_threadpool(
+            get_status_snapshots, collection_operation_ids
+        )
+    except Exception:
+        redis_rq.broadcaster.unsubscribe(collection_operation_ids, loop, queue)
+        raise
+
+    statuses = {s["id"]: s["status"] for s in snapshots}
+
+    async def stream():
+        try:
+            for snapshot in snapshots:
+                yield get_event(snapshot)
+
+            while any(s not in FINISHED_STATUSES for s in statuses.values()):
+                try:
+                    data = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                event = json.loads(data)
+                if event.get("event") == "status":
+                    statuses[event["id"]] = event["status"]
+
+                yield f"data: {data}\n\n"
+        finally:
+            redis_rq.broadcaster.unsubscribe(collection_operation_ids, loop, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get(
     "/{collection_operation_id}",
     response_model_by_alias=False,
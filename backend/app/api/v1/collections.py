@@ -1,10 +1,10 @@
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import Response
+from fastapi import APIRouter, HTTPException, Depends, Request
 
 import datetime
 import pathlib
 
 from app import models, config
+from app.api.utils import file_responses, renderers
 from .. import schemas
 from .. import core
 
@@ -35,6 +35,8 @@ def create(
 
     db_collection = models.Collection(**data)
     db_collection.owner = current_user
+    # a new collection has no tokens, so its zero counters are exact
+    db_collection.trait_counted = True
     db_collection.save()
 
     if collection.file_api_key:
@@ -59,9 +61,18 @@ def get_art_images(collection_id: str, art_file_name: str):
             detail=f"There are no {collection_id} collection in system",
         )
 
-    db_art_image = models.ArtImage.objects(
-        collection=db_collection, name=f"{art_file_name}.png"
-    ).first()
+    art_images = models.ArtImage.objects(collection=db_collection)
+    db_art_image = None
+    if art_file_name.isdigit():
+        db_art_image = art_images.filter(token_id=int(art_file_name)).first()
+
+    if not db_art_image:
+        # tokens without a token_id are only known by name, in any encoding
+        extensions = sorted({f[2] for f in renderers.ENCODER_FORMATS.values()})
+        db_art_image = art_images.filter(
+            name__in=[f"{art_file_name}.{extension}" for extension in extensions]
+        ).first()
+
     if not db_art_image:
         raise HTTPException(
             status_code=404,
@@ -69,8 +80,8 @@ def get_art_images(collection_id: str, art_file_name: str):
         )
     data = {
         "file_id": str(db_art_image.id),
-        "file_name": db_art_image.name,
-        "download": f"localhost:8081/v1/art-images/{db_art_image.id}/download/{art_file_name}.png",
+        "file_name": db_art_image.filename or db_art_image.name,
+        "download": db_art_image.url,
     }
     return data
 
@@ -178,8 +189,11 @@ def delete(
         ai.image.delete()
         ai.delete()
 
+    models.PreviewImage.objects(collection=db_collection).delete()
+
     for ci in db_component_images:
         ci.image.delete()
+        ci.cropped_image.delete()
         ci.delete()
 
     for il in db_image_layers:
@@ -270,6 +284,7 @@ def get_file_host(
 def download_collection(
     collection_id: str,
     archive_name: str,
+    request: Request,
     # current_user: models.User = Depends(core.deps.get_current_user),
 ):
     db_collection = models.Collection.objects(
@@ -292,9 +307,6 @@ def download_collection(
             detail=f"There are no archive file for {db_collection.id} in system",
         )
 
-    data = None
-    with open(archive, "rb") as f:
-        data = f.read()
-
-    content_type = "application/zip, application/octet-stream, application/x-zip-compressed, multipart/x-zip"
-    return Response(content=data, media_type=content_type)
+    return file_responses.file_response(
+        archive, request, "application/zip", filename=archive_name
+    )
@@ -136,6 +136,7 @@ def delete(
 
     data = schemas.component_images.ComponentImageSchema.from_orm(db_component_image)
     db_component_image.image.delete()
+    db_component_image.cropped_image.delete()
     db_component_image.delete()
 
     return data
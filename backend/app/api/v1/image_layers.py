@@ -149,6 +149,7 @@ def delete(
 
     for component_image in db_component_images:
         component_image.image.delete()
+        component_image.cropped_image.delete()
         component_image.delete()
 
     data = schemas.image_layers.ImageLayerSchema.from_orm(db_image_layer)
@@ -199,6 +200,7 @@ def upload_component_images(
             content_type=file.content_type,
             filename=file.filename,
         )
+        component_image.update_bbox()
 
         component_image.save()
         component_images.append(component_image)
@@ -236,6 +238,7 @@ def delete_component_images(
 
     for component_image in db_component_images:
         component_image.image.delete()
+        component_image.cropped_image.delete()
         component_image.delete()
 
     return data
@@ -0,0 +1,235 @@
+import argparse
+import concurrent.futures
+import datetime
+import io
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+import uuid
+
+import mongoengine as me
+from PIL import Image, ImageDraw
+
+from app import models
+from app.api.jobs import art_generator
+
+
+def connect(mongo, dbname):
+    if mongo == "mongomock":
+        try:
+            import mongomock
+            from mongomock import gridfs as mongomock_gridfs
+        except ImportError:
+            sys.exit("mongomock is not installed, pass --mongo mongodb://host:port")
+
+        mongomock_gridfs.enable_gridfs_integration()
+        print("mongomock", mongomock.__version__)
+        return me.connect(db=dbname, host="mongomock://localhost")
+
+    return me.connect(db=dbname, host=mongo)
+
+
+def create_layer_image(rng, size, transparency, opaque=False):
+    img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    color = tuple(rng.randrange(256) for _ in range(3)) + (255,)
+    if opaque:
+        img.paste(color, (0, 0, size, size))
+    else:
+        # one solid block covering the non transparent share of the canvas
+        side = round(size * max(1 - transparency, 0) ** 0.5)
+        if side > 0:
+            x = rng.randrange(size - side + 1)
+            y = rng.randrange(size - side + 1)
+            ImageDraw.Draw(img).rectangle((x, y, x + side - 1, y + side - 1), color)
+
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format="PNG")
+    img_bytes.seek(0)
+    return img_bytes
+
+
+def create_collection(args, rng):
+    user = models.User(
+        email=f"benchmark-{uuid.uuid4().hex}@example.com",
+        first_name="benchmark",
+        last_name="benchmark",
+    )
+    user.save()
+
+    collection = models.Collection(name="benchmark", owner=user, trait_counted=True)
+    collection.save()
+
+    for i in range(args.layers):
+        image_layer = models.ImageLayer(
+            name=f"layer-{i}",
+            order=i,
+            required=True,
+            owner=user,
+            collection=collection,
+        )
+        image_layer.save()
+
+        for j in range(args.traits):
+            component = models.ComponentImage(
+                name=f"trait-{i}-{j}",
+                owner=user,
+                image_layer=image_layer,
+                component_class="A",
+                rarity_weight=100 / args.traits,
+            )
+            component.image.put(
+                create_layer_image(rng, args.size, args.transparency, opaque=i == 0),
+                content_type="image/png",
+                filename=f"trait-{i}-{j}.png",
+            )
+            component.update_bbox()
+            component.save()
+
+    return user, collection
+
+
+def reset(collection):
+    models.ArtImage.objects(collection=collection).delete()
+    db = models.ArtImage._get_db()
+    db["art_images.files"].delete_many({})
+    db["art_images.chunks"].delete_many({})
+    models.ComponentImage.objects(owner=collection.owner).update(
+        set__generated_number=0
+    )
+
+
+def get_peak_rss():
+    # ru_maxrss is a lifetime peak in kilobytes on linux, workers are counted
+    # as children
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return dict(self_mb=rss / 1024, children_mb=children / 1024)
+
+
+def run_generator(args, user, collection, generated_type):
+    reset(collection)
+
+    collection_operation = models.CollectionOperation(
+        command_type="generate",
+        collection=collection,
+        owner=user,
+        amount=args.amount,
+        parameters=dict(
+            generated_type=generated_type,
+            generated_class="A",
+            workers=args.workers,
+            compositor=args.compositor,
+            render_mode=args.render_mode,
+            batch_size=args.batch_size,
+            seed=args.seed,
+        ),
+        submitted_date=datetime.datetime.utcnow(),
+    )
+    collection_operation.save()
+
+    generator = art_generator.GENERATORS[generated_type](collection_operation)
+
+    started = time.perf_counter()
+    generator.run()
+    elapsed = time.perf_counter() - started
+
+    collection_operation.reload()
+    message = collection_operation.message
+    images = models.ArtImage.objects(command=collection_operation).count()
+
+    return dict(
+        generator=generated_type,
+        status=collection_operation.status,
+        images=images,
+        seconds=elapsed,
+        images_per_second=images / elapsed if elapsed > 0 else 0,
+        peak_rss=get_peak_rss(),
+        stages=message.get("progress", {}).get("stages", {}),
+        render=message.get("render", {}),
+        encoder=message.get("encoder", {}),
+        dna=message.get("dna", {}),
+    )
+
+
+def run_isolated(args, generated_type):
+    dbname = f"benchmark_{uuid.uuid4().hex[:8]}"
+    client = connect(args.mongo, dbname)
+    try:
+        rng = random.Random(args.seed)
+
+        started = time.perf_counter()
+        user, collection = create_collection(args, rng)
+        setup_seconds = time.perf_counter() - started
+        print("synthetic collection", f"{setup_seconds:.1f}s")
+
+        setup_rss = get_peak_rss()
+        run = run_generator(args, user, collection, generated_type)
+    finally:
+        client.drop_database(dbname)
+        me.disconnect()
+
+    run["setup_seconds"] = setup_seconds
+    run["setup_peak_rss"] = setup_rss
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate art for a synthetic collection and report throughput"
+    )
+    parser.add_argument("--layers", type=int, default=6)
+    parser.add_argument("--traits", type=int, default=10)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument(
+        "--transparency",
+        type=float,
+        default=0.75,
+        help="transparent share of every layer above the first",
+    )
+    parser.add_argument("--amount", type=int, default=200)
+    parser.add_argument("--generators", default="normal-random,random-after")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--compositor", default="pillow")
+    parser.add_argument("--render-mode", default="eager")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--mongo",
+        default="mongomock",
+        help="mongomock or a mongodb url, a throwaway database is used",
+    )
+    parser.add_argument("--output", help="write the json report to this file")
+    args = parser.parse_args()
+
+    generated_types = [g for g in args.generators.split(",") if g]
+    for generated_type in generated_types:
+        if generated_type not in art_generator.GENERATORS:
+            parser.error(f"generated type {generated_type} not found")
+
+    # a fresh process per run keeps peak rss from carrying over between runs
+    runs = []
+    for generated_type in generated_types:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            runs.append(executor.submit(run_isolated, args, generated_type).result())
+
+    report = dict(
+        python=platform.python_version(),
+        config=vars(args),
+        runs=runs,
+    )
+
+    data = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data)
+    print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,11 @@ class Settings(BaseSettings):
 
     HERMES_DATA_DIR: str = os.getenv("HERMES_DATA_DIR", "/tmp/hermes")
 
+    LAYER_CACHE_SIZE: int = os.getenv("LAYER_CACHE_SIZE", 512 * 1024 * 1024)
+    PREFIX_CACHE_SIZE: int = os.getenv("PREFIX_CACHE_SIZE", 256 * 1024 * 1024)
+    RENDER_CACHE_SIZE: int = os.getenv("RENDER_CACHE_SIZE", 1024 * 1024 * 1024)
+    PREVIEW_TTL: int = os.getenv("PREVIEW_TTL", 24 * 60 * 60)
+
 
 class DevelopmentConfig(Settings):
     CONFIG_NAME: str = "development"
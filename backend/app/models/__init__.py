@@ -1,7 +1,7 @@
 import mongoengine as me
 from .users import User
 from .collections import Collection, ImageLayer, ComponentImage, CollectionOperation
-from .images import ArtImage
+from .images import ArtImage, PreviewImage
 
 
 def init_mongoengine(settings):
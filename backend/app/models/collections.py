@@ -1,5 +1,7 @@
 import mongoengine as me
 import datetime
+import io
+import json
 import os
 import string
 import base64
@@ -9,6 +11,7 @@ from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 
 from . import images
+from app.api.utils import renderers
 
 METADATA_FORMATS = [("opensea", "OpenSea")]
 FILE_HOSTS = [("pinata", "Pinata")]
@@ -33,6 +36,10 @@ class Collection(me.Document):
     updated_date = me.DateTimeField(required=True, default=datetime.datetime.utcnow)
 
     generated_trait = me.IntField(required=True, default=0)
+    encoder = me.DictField()
+    rarity_version = me.IntField(required=True, default=0)
+    # usage counters are only trusted once a full count has rebuilt them
+    trait_counted = me.BooleanField(required=True, default=False)
 
     file_api_key = me.BinaryField(default=b"")
     file_api_secret = me.BinaryField(default=b"")
@@ -82,6 +89,8 @@ class ComponentImage(me.Document):
     name = me.StringField(required=True, max_length=256, default="component")
     description = me.StringField()
     image = me.ImageField(collection_name="component_images")
+    cropped_image = me.ImageField(collection_name="component_images")
+    bbox = me.ListField(me.IntField())
 
     owner = me.ReferenceField("User", dbref=True, required=True)
     image_layer = me.ReferenceField("ImageLayer", dbref=True, required=True)
@@ -120,6 +129,50 @@ class ComponentImage(me.Document):
 
         return None
 
+    def read_layer(self, cropped=False):
+        if cropped and self.bbox:
+            if not any(self.bbox):
+                return None, None
+
+            # opaque layers keep no cropped copy, the whole image is the crop
+            if self.cropped_image:
+                self.cropped_image.seek(0)
+                return self.cropped_image.read(), tuple(self.bbox[:2])
+
+        self.image.seek(0)
+        return self.image.read(), (0, 0)
+
+    @classmethod
+    def load_layer(cls, component_id, cropped=False):
+        return cls.objects(id=component_id).first().read_layer(cropped)
+
+    def update_bbox(self):
+        self.image.seek(0)
+        img = renderers.decode_image(self.image.read())
+        bbox = renderers.get_alpha_bbox(img)
+
+        if self.cropped_image:
+            self.cropped_image.delete()
+
+        if not bbox:
+            self.bbox = [0, 0, 0, 0]
+            return
+
+        self.bbox = list(bbox)
+        if bbox == (0, 0, img.width, img.height):
+            return
+
+        img_bytes = io.BytesIO()
+        img.crop(bbox).save(img_bytes, format="PNG")
+        img_bytes.seek(0)
+        self.cropped_image.put(
+            img_bytes, content_type="image/png", filename=f"cropped-{self.filename}"
+        )
+
+    def has_full_crop(self):
+        # layers cropped before opaque ones were skipped hold a full copy
+        return bool(self.cropped_image) and self.bbox == [0, 0, *self.image.size]
+
     def count_art_image(self):
         return images.ArtImage.objects(components=self).count()
 
@@ -161,3 +214,23 @@ class CollectionOperation(me.Document):
     completed_date = me.DateTimeField()
 
     message = me.DictField()
+    plan = me.DictField()
+    checkpoint = me.DictField()
+
+    def put_checkpoint_data(self, data):
+        proxy = me.GridFSProxy(collection_name="checkpoints")
+        proxy.put(
+            json.dumps(data).encode(),
+            content_type="application/json",
+            filename=f"{self.id}.json",
+        )
+        return proxy.grid_id
+
+    @staticmethod
+    def read_checkpoint_data(grid_id):
+        proxy = me.GridFSProxy(grid_id, collection_name="checkpoints")
+        return json.loads(proxy.read())
+
+    @staticmethod
+    def delete_checkpoint_data(grid_id):
+        me.GridFSProxy(grid_id, collection_name="checkpoints").delete()
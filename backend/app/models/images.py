@@ -1,17 +1,23 @@
 import mongoengine as me
+from mongoengine.base import get_document
 import datetime
+import hashlib
+import io
+import json
 import os
-from app.api.utils import metadata_generators
+from app import config
+from app.api.utils import metadata_generators, renderers, render_cache
 
 
 class ArtImage(me.Document):
-    meta = {"collection": "art_images"}
+    meta = {"collection": "art_images", "indexes": [("collection", "dna_hash")]}
 
     name = me.StringField(required=True, max_length=256, default="ArtImage")
     description = me.StringField(default="")
 
     rarity = me.FloatField(required=True, default=0)
     rarity_percent = me.FloatField(required=True, default=0)
+    rarity_version = me.IntField(required=True, default=-1)
 
     image_class = me.StringField(required=True, default="A")
     image = me.ImageField(collection_name="art_images")
@@ -24,20 +30,102 @@ class ArtImage(me.Document):
     command = me.ReferenceField("CollectionOperation", dbref=True, required=True)
     created_date = me.DateTimeField(required=True, default=datetime.datetime.utcnow)
 
+    dna_hash = me.StringField()
+    token_id = me.IntField()
+    render_spec = me.DictField()
+
+    @staticmethod
+    def get_dna_hash(component_ids):
+        dna = ",".join(str(component_id) for component_id in component_ids)
+        return hashlib.sha1(dna.encode()).hexdigest()
+
+    @staticmethod
+    def get_filename(token_id, image_filename):
+        if not token_id:
+            return image_filename
+
+        extension = "png"
+        if image_filename and "." in image_filename:
+            extension = image_filename.rsplit(".", 1)[-1]
+
+        return f"{token_id}.{extension}"
+
     @property
-    def filename(self):
+    def image_filename(self):
         if self.image:
             return self.image.filename
 
+        return self.render_spec.get("filename")
+
+    @property
+    def content_type(self):
+        if self.image:
+            return self.image.content_type
+
+        return self.render_spec.get("content_type")
+
+    @property
+    def filename(self):
+        image_filename = self.image_filename
+        if image_filename:
+            return self.get_filename(self.token_id, image_filename)
+
         return None
 
     @property
     def uri(self):
-        if self.image:
-            return f"/v1/art-images/{self.id}/download/{self.image.filename}"
+        if self.image_filename:
+            return f"/v1/art-images/{self.id}/download/{self.filename}"
 
         return None
 
+    @staticmethod
+    def get_renderer(cache_size=None):
+        ComponentImage = get_document("ComponentImage")
+        return renderers.ImageRenderer(
+            ComponentImage.load_layer, cache_size or config.settings.LAYER_CACHE_SIZE
+        )
+
+    def get_render_key(self):
+        spec = dict(
+            components=[
+                [str(c.id), str(c.image.grid_id), c.bbox] for c in self.components
+            ],
+            encoder=self.render_spec.get("encoder", {}),
+        )
+        return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+    def render_image(self, renderer=None):
+        if renderer is None:
+            renderer = self.get_renderer()
+
+        img = renderer.composite([c.id for c in self.components])
+        encoder = renderers.ImageEncoder(self.render_spec.get("encoder"))
+        return encoder.encode(img)
+
+    def read_image(self, renderer=None):
+        if self.image:
+            self.image.seek(0)
+            return self.image.read()
+
+        cache = render_cache.get_render_cache()
+        key = self.get_render_key()
+        data = cache.get(key)
+        if data is None:
+            data = self.render_image(renderer)
+            cache.put(key, data)
+
+        return data
+
+    def open_image(self, renderer=None):
+        # stored images stream from gridfs chunk by chunk
+        if self.image:
+            grid_out = self.image.get()
+            grid_out.seek(0)
+            return grid_out
+
+        return io.BytesIO(self.read_image(renderer))
+
     @property
     def url(self):
         base_url = os.getenv("BASE_URL", "http://localhost:8081")
@@ -63,3 +151,34 @@ class ArtImage(me.Document):
                 rarity_percent=component.rarity_percent,
             )
         return data
+
+
+def get_preview_expires_at():
+    return datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=config.settings.PREVIEW_TTL
+    )
+
+
+class PreviewImage(me.Document):
+    meta = {
+        "collection": "preview_images",
+        "indexes": [
+            ("command", "token_id"),
+            {"fields": ["expires_at"], "expireAfterSeconds": 0},
+        ],
+    }
+
+    collection = me.ReferenceField("Collection", dbref=True, required=True)
+    command = me.ReferenceField("CollectionOperation", dbref=True, required=True)
+    components = me.ListField(
+        me.ReferenceField("ComponentImage", dbref=True, required=True)
+    )
+    token_id = me.IntField(required=True)
+
+    data = me.BinaryField(required=True)
+    content_type = me.StringField(required=True, default="image/png")
+    width = me.IntField()
+    height = me.IntField()
+
+    created_date = me.DateTimeField(required=True, default=datetime.datetime.utcnow)
+    expires_at = me.DateTimeField(required=True, default=get_preview_expires_at)
@@ -10,6 +10,7 @@ import redis
 from rq import Worker, Queue, Connection, SimpleWorker
 
 from app import models
+from app.api import redis_rq
 
 import logging
 
@@ -24,6 +25,7 @@ class ViyyoorWorker(SimpleWorker):
         super().__init__(*args, **kwargs)
 
         models.init_mongoengine(settings)
+        redis_rq.init_rq(settings)
 
 
 class WorkerServer:
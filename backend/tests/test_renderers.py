@@ -0,0 +1,115 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.api.utils import renderers
+
+SIZE = 48
+
+
+def encode(img):
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format="PNG")
+    return img_bytes.getvalue()
+
+
+def random_layer(rng, mode="RGBA", box=None):
+    channels = len(mode)
+    pixels = rng.integers(0, 256, (SIZE, SIZE, channels), dtype=np.uint8)
+    if mode == "RGBA":
+        # mix fully transparent, semi transparent and opaque pixels
+        alpha = rng.choice([0, 1, 64, 128, 200, 254, 255], (SIZE, SIZE))
+        pixels[:, :, 3] = alpha
+        if box:
+            mask = np.zeros((SIZE, SIZE), dtype=bool)
+            mask[box[1] : box[3], box[0] : box[2]] = True
+            pixels[~mask, 3] = 0
+
+    return Image.fromarray(pixels, mode)
+
+
+class LayerStore:
+    """Stored layers with their alpha-bbox crops, like ComponentImage."""
+
+    def __init__(self, layers):
+        self.layers = {}
+        for key, img in layers.items():
+            cropped = (None, None)
+            if img.mode == "RGBA":
+                bbox = renderers.get_alpha_bbox(img)
+                if bbox:
+                    cropped = (encode(img.crop(bbox)), bbox[:2])
+            else:
+                cropped = (encode(img), (0, 0))
+
+            self.layers[(key, False)] = (encode(img), (0, 0))
+            self.layers[(key, True)] = cropped
+
+    def __call__(self, key, cropped=False):
+        return self.layers[(key, cropped)]
+
+
+@pytest.fixture
+def store():
+    rng = np.random.default_rng(0)
+    layers = {
+        "rgb-base": random_layer(rng, "RGB"),
+        "rgba-base": random_layer(rng),
+        "full": random_layer(rng),
+        "corner": random_layer(rng, box=(2, 3, 17, 11)),
+        "edge": random_layer(rng, box=(30, 40, 48, 48)),
+        "blank": Image.new("RGBA", (SIZE, SIZE)),
+    }
+    return LayerStore(layers)
+
+
+STACKS = [
+    ["rgba-base", "full"],
+    ["rgba-base", "corner", "edge"],
+    ["rgba-base", "corner", "blank", "full", "edge"],
+    ["rgba-base", "blank"],
+    ["rgb-base", "corner", "full"],
+    ["rgb-base", "edge", "corner"],
+]
+
+
+def render(compositor, store, stacks, prefix_cache_size=0, base=None):
+    renderer = renderers.get_renderer(compositor, store, 2**26, prefix_cache_size)
+    renderer.set_base(base or [])
+    return renderer.composite_many(stacks)
+
+
+def assert_identical(pillow_imgs, numpy_imgs):
+    for pillow_img, numpy_img in zip(pillow_imgs, numpy_imgs):
+        assert pillow_img.mode == numpy_img.mode
+        assert np.array_equal(np.asarray(pillow_img), np.asarray(numpy_img))
+
+
+@pytest.mark.parametrize("stack", STACKS)
+def test_numpy_matches_pillow(store, stack):
+    assert_identical(render("pillow", store, [stack]), render("numpy", store, [stack]))
+
+
+def test_numpy_matches_pillow_in_batches(store):
+    assert_identical(render("pillow", store, STACKS), render("numpy", store, STACKS))
+
+
+def test_numpy_matches_pillow_with_prefixes(store):
+    stacks = [
+        ["rgba-base", "corner", "full"],
+        ["rgba-base", "corner", "edge"],
+        ["rgba-base", "corner", "edge", "full"],
+    ]
+    base = ["rgba-base", "corner"]
+
+    pillow_imgs = render("pillow", store, stacks, 2**26, base)
+    assert_identical(pillow_imgs, render("numpy", store, stacks, 2**26, base))
+    assert_identical(pillow_imgs, render("pillow", store, stacks))
+
+
+def test_opaque_base_keeps_rgb(store):
+    for compositor in ["pillow", "numpy"]:
+        imgs = render(compositor, store, [["rgb-base", "full"], ["rgba-base", "full"]])
+        assert [img.mode for img in imgs] == ["RGB", "RGBA"]
@@ -0,0 +1,40 @@
+import itertools
+import random
+
+import pytest
+
+from app.api.utils import samplers
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_quota_plan_fills_every_combination(seed):
+    planner = samplers.QuotaPlanner(
+        [[2, 2], [2, 2]], [None, None], 4, rng=random.Random(seed)
+    )
+    plan = planner.plan()
+
+    assert len(plan) == 4
+    assert sorted(plan) == list(itertools.product(range(2), range(2)))
+    assert planner.report["unresolved"] == 0
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_quota_plan_meets_feasible_quotas(seed):
+    columns = [[3, 3, 2], [4, 4], [2, 2, 2, 2]]
+    planner = samplers.QuotaPlanner(
+        columns, [None] * len(columns), 8, rng=random.Random(seed)
+    )
+    plan = planner.plan()
+
+    assert len(plan) == 8
+    assert len(set(plan)) == 8
+    for layer, quotas in enumerate(columns):
+        counts = [sum(1 for row in plan if row[layer] == i) for i in range(len(quotas))]
+        assert counts == quotas
+
+
+def test_product_sampler_draws_every_index_once():
+    sampler = samplers.ProductSampler([3, 4, 2], random.Random(0))
+    drawn = list(sampler)
+
+    assert sorted(drawn) == list(itertools.product(range(3), range(4), range(2)))